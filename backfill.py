@@ -0,0 +1,272 @@
+# -*- mode: python ; coding: utf-8 -*-
+'''
+Backfill the APOD library with every APOD in a range of dates. Metadata
+and images are fetched concurrently, each finished download is then
+thumbnailed and cropped on a pool of worker processes. Finished entries
+are appended to the data file and checkpointed in batches, at least every
+FLUSH_INTERVAL seconds.
+
+    fetchAPOD.py backfill --from 1995-06-16 --to today --concurrency 16
+ '''
+
+import asyncio
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+from fetchAPOD import (init_session, test_connection, formulate_data,
+                       download_apod, make_url, check_data_exists,
+                       check_folders_exist, check_data_header,
+                       append_data_rows, reset_field_dict, init_cache)
+from config import SetupConfig
+from cache import cache_path, RECENT_DAYS
+from ratelimit import RATE_MAX_WAIT
+from imagepool import (image_job, process_image, apply_result, pool_size,
+                       image_executor)
+
+FIRST_APOD = date(1995, 6, 16)
+# Finished entries appended to the data file in one write.
+BATCH_SIZE = 50
+# Seconds a finished entry waits at most before the batch is written.
+FLUSH_INTERVAL = 5
+# Error responses that are final for a date, once it is not recent.
+FINAL_ERRORS = (400, 404)
+# Error responses for the api key, the rest of the run would fail too.
+KEY_ERRORS = (401, 403)
+
+
+def parse_date(value):
+    '''Parse a YYYY-MM-DD date, or "today".'''
+    if value.lower() == "today":
+        return date.today()
+
+    try:
+        return date.fromisoformat(value)
+
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date: {value}")
+
+
+def date_range(start, end):
+    '''Yield every date from start to end, both included.'''
+    for offset in range((end - start).days + 1):
+        yield start + timedelta(days=offset)
+
+
+def checkpoint_path(DATA_FILE):
+    '''Return the path of the backfill checkpoint next to the data file.'''
+    return Path(DATA_FILE).parent.joinpath("backfill.checkpoint")
+
+
+def read_checkpoint(checkpoint_file):
+    '''Return a set of the dates already handled by a previous backfill.'''
+    try:
+        with open(checkpoint_file, "r") as checkpoint:
+            return {line.strip() for line in checkpoint if line.strip()}
+
+    except (FileNotFoundError, PermissionError, OSError):
+        return set()
+
+
+def write_checkpoint(checkpoint_file, apod_date):
+    '''Append a handled date to the checkpoint.'''
+    try:
+        with open(checkpoint_file, "a") as checkpoint:
+            checkpoint.write(f"{apod_date}\n")
+
+    except (PermissionError, OSError) as error:
+        print(f"write_checkpoint: {error}")
+
+
+def fetch_metadata(conf, apod_date, stop):
+    '''
+    Fetch the metadata of one date. Return the response, or None on a
+    network error, a rate limit or server side failure so it is retried
+    next time. A rejected API_KEY sets stop to end the run.
+    '''
+    url, _ = make_url(conf.API_KEY, apod_date.year, apod_date.month,
+                      apod_date.day)
+    resp = test_connection(url, max_wait=RATE_MAX_WAIT)
+
+    if resp is None or resp.status_code == 429 or resp.status_code >= 500:
+        return None
+
+    if resp.status_code in KEY_ERRORS:
+        if not stop.is_set():
+            print(f"backfill: {resp.status_code} {resp.text}, check API_KEY")
+            stop.set()
+
+        return None
+
+    return resp
+
+
+def is_final(resp, apod_date):
+    '''
+    Return True if a response that gave no image settles its date. A 200
+    is a duplicate or other media, a 400 or 404 is only trusted once the
+    date is older than RECENT_DAYS, it may not be published yet.
+    '''
+    if resp.status_code == 200:
+        return True
+
+    return (resp.status_code in FINAL_ERRORS
+            and apod_date < date.today() - timedelta(days=RECENT_DAYS))
+
+
+def flush_batch(conf, batch, checkpoint_file):
+    '''Append a batch of finished entries, then checkpoint their dates.'''
+    if len(batch) == 0:
+        return
+
+    append_data_rows(conf.DATA_FILE, conf.FIELD_NAMES,
+                     [field_dict for field_dict, apod_date in batch])
+
+    for field_dict, apod_date in batch:
+        write_checkpoint(checkpoint_file, apod_date.isoformat())
+
+    batch.clear()
+
+
+async def backfill_date(conf, apod_date, semaphore, data_lock,
+                        checkpoint_file, executor, image_slots, batch, stop):
+    '''Fetch, process and checkpoint a single date.'''
+    field_dict = reset_field_dict(conf.field_dict)
+    date_time = str(datetime.now().strftime("%Y%m%d%H%M%S%f"))
+
+    async with semaphore:
+        if stop.is_set():
+            return
+
+        resp = await asyncio.to_thread(fetch_metadata, conf, apod_date,
+                                       stop)
+
+        if resp is None:
+            print(f"backfill: {apod_date} failed, will retry on next run")
+            return
+
+        # formulate_data checks the data file for duplicates, keep it
+        # from reading while another date is being appended.
+        async with data_lock:
+            data = await asyncio.to_thread(
+                    formulate_data, conf.DATA_FILE, conf.QUALITY,
+                    conf.API_KEY, conf.FIELD_NAMES, conf.REDOWNLOAD,
+                    field_dict, date_time, resp)
+
+        result = False
+
+        if data is True:
+            result = await asyncio.to_thread(download_apod, conf.IMAGE_DIR,
+                                             field_dict)
+
+            if result is False:
+                print(f"backfill: {apod_date} download failed, will retry"
+                      + " on next run")
+                return
+
+    if result is not True:
+        if not is_final(resp, apod_date):
+            print(f"backfill: {apod_date} {resp.status_code}, will retry"
+                  + " on next run")
+            return
+
+        async with data_lock:
+            write_checkpoint(checkpoint_file, apod_date.isoformat())
+
+        return
+
+    # image_slots bounds the jobs queued on the worker processes.
+    async with image_slots:
+        image = await asyncio.get_running_loop().run_in_executor(
+                executor, process_image,
+                image_job(conf.IMAGE_DIR, conf.TIMG_DIR,
+                          field_dict["filename"], conf.MIN_SIZE,
+                          conf.CROP_RATIO))
+
+    if image["error"] is not None:
+        print(f"backfill: {apod_date} {image['error']}")
+
+    apply_result(field_dict, image)
+
+    async with data_lock:
+        field_dict["uid"] = str(datetime.now().strftime("%Y%m%d%H%M%S%f"))
+        batch.append((field_dict, apod_date))
+        print(f"backfill: {apod_date} {field_dict['filename']}")
+
+        if len(batch) >= BATCH_SIZE:
+            await asyncio.to_thread(flush_batch, conf, batch, checkpoint_file)
+
+
+async def flush_periodically(conf, batch, data_lock, checkpoint_file):
+    '''
+    Write the batch every FLUSH_INTERVAL seconds, so a killed backfill
+    loses at most that much work. backfill cancels the task only while it
+    holds data_lock, so never in the middle of a write.
+    '''
+    while True:
+        await asyncio.sleep(FLUSH_INTERVAL)
+
+        async with data_lock:
+            await asyncio.to_thread(flush_batch, conf, batch, checkpoint_file)
+
+
+async def backfill(conf, start, end, concurrency):
+    '''Backfill every date from start to end with bounded parallelism.'''
+    checkpoint_file = checkpoint_path(conf.DATA_FILE)
+    done = read_checkpoint(checkpoint_file)
+    dates = [apod_date for apod_date in date_range(start, end)
+             if apod_date.isoformat() not in done]
+
+    print(f"backfill: {len(dates)} dates to fetch, {len(done)} already done")
+
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=concurrency))
+    semaphore = asyncio.Semaphore(concurrency)
+    data_lock = asyncio.Lock()
+    image_slots = asyncio.Semaphore(pool_size(conf.WORKERS) * 2)
+    batch = []
+    # set from the metadata threads, so not an asyncio.Event.
+    stop = threading.Event()
+
+    with image_executor(conf.WORKERS) as executor:
+        flusher = asyncio.create_task(flush_periodically(
+                conf, batch, data_lock, checkpoint_file))
+
+        try:
+            await asyncio.gather(*[
+                backfill_date(conf, apod_date, semaphore, data_lock,
+                              checkpoint_file, executor, image_slots, batch,
+                              stop)
+                for apod_date in dates])
+
+        finally:
+            async with data_lock:
+                flusher.cancel()
+                await asyncio.to_thread(flush_batch, conf, batch,
+                                        checkpoint_file)
+
+
+def main(argv=None):
+    '''Parse the backfill arguments and run the backfill.'''
+    parser = argparse.ArgumentParser(prog="fetchAPOD.py backfill")
+    parser.add_argument("--from", dest="start", type=parse_date,
+                        default=FIRST_APOD)
+    parser.add_argument("--to", dest="end", type=parse_date,
+                        default=date.today())
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args(argv)
+
+    conf = SetupConfig()
+    start = max(args.start, FIRST_APOD)
+    concurrency = max(1, args.concurrency)
+
+    check_data_exists(conf.DATA_FILE)
+    check_folders_exist(conf.IMAGE_DIR, conf.TIMG_DIR)
+    check_data_header(conf.DATA_FILE, conf.FIELD_NAMES)
+    init_session(max(int(conf.POOL_SIZE), concurrency), conf.RETRIES,
+                 conf.BACKOFF)
+    init_cache(cache_path(conf.DATA_FILE))
+
+    asyncio.run(backfill(conf, start, args.end, concurrency))
@@ -0,0 +1,232 @@
+# -*- mode: python ; coding: utf-8 -*-
+'''
+Persistent cache of APOD api responses keyed by date. Dated entries
+never change once published and are kept forever, the entry for today
+expires after CACHE_TTL seconds. Dates that are not images are kept as
+small negative entries so they are never requested again, except errors
+for the last RECENT_DAYS, which may only not be published yet and expire
+like today.
+ '''
+
+import time
+from datetime import date, timedelta
+from pathlib import Path
+from json import loads, dumps, decoder
+
+from storage import FileLock, write_atomic
+
+# Seconds the response for today is served from the cache.
+CACHE_TTL = 60 * 60
+# Days before today an error response is not trusted to be final.
+RECENT_DAYS = 3
+# Superseded lines the cache file may hold before it is rewritten.
+COMPACT_LINES = 1000
+
+
+def cache_path(DATA_FILE):
+    '''Return the path of the metadata cache next to the data file.'''
+    return Path(DATA_FILE).parent.joinpath("metadata.cache")
+
+
+class CachedResponse:
+    '''Stand-in for a requests response served from the cache.'''
+
+    def __init__(self, text, status_code=200, headers=None):
+        self.text = text
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def json(self):
+        return loads(self.text)
+
+    def close(self):
+        pass
+
+
+class MetadataCache:
+    '''
+    Date keyed cache stored as an append only file of json lines, the
+    last line for a date wins. Once more than COMPACT_LINES lines are
+    superseded the file is rewritten with one line per date. Loaded once,
+    safe to share across threads and processes.
+    '''
+
+    def __init__(self, CACHE_FILE, ttl=CACHE_TTL):
+        self.cache_file = CACHE_FILE
+        self.ttl = ttl
+        self.entries = {}
+        self.lines = 0
+        self.lock = FileLock(f"{CACHE_FILE}.lock")
+        self.load()
+
+    def read(self):
+        '''Return the entries and the number of lines of the cache file.'''
+        entries = {}
+        lines = 0
+
+        with open(self.cache_file, "r") as cache_file:
+            for line in cache_file:
+                lines += 1
+
+                try:
+                    entry = loads(line)
+                    entries[entry["key"]] = entry
+
+                except (decoder.JSONDecodeError, KeyError, TypeError):
+                    continue
+
+        return entries, lines
+
+    def load(self):
+        try:
+            with self.lock:
+                self.entries, self.lines = self.read()
+
+                if self.lines - len(self.entries) > COMPACT_LINES:
+                    self.compact()
+
+        except FileNotFoundError:
+            pass
+
+        except (PermissionError, OSError) as error:
+            print(f"MetadataCache.load: {error}")
+
+    def compact(self):
+        '''
+        Rewrite the cache file with only the last line of every date. The
+        file is read again under the lock so lines appended by another
+        process are kept.
+        '''
+        with self.lock:
+            entries, _ = self.read()
+
+            def write(cache_file):
+                for entry in entries.values():
+                    cache_file.write(dumps(entry) + "\n")
+
+            write_atomic(self.cache_file, write)
+            self.entries.update(entries)
+            self.lines = len(entries)
+
+    def get(self, key):
+        '''Return a CachedResponse for key, None if missing or expired.'''
+        entry = self.entries.get(key)
+
+        if entry is None:
+            return None
+
+        if (not self.is_final(key)
+                and time.time() - entry["fetched"] > self.ttl):
+            return None
+
+        return CachedResponse(entry["text"], entry["status"])
+
+    def is_final(self, key):
+        '''
+        Return True if a cached entry never changes. The entry for today
+        and errors for recent dates are not final.
+        '''
+        entry = self.entries.get(key)
+
+        if key == "today" or entry is None:
+            return False
+
+        if entry["status"] == 200:
+            return True
+
+        try:
+            return (date.fromisoformat(key)
+                    < date.today() - timedelta(days=RECENT_DAYS))
+
+        except ValueError:
+            return False
+
+    def media_type(self, key):
+        '''Return the cached media type of a date, None if unknown.'''
+        entry = self.entries.get(key)
+
+        if entry is None:
+            return None
+
+        return entry["media_type"]
+
+    def date(self, key):
+        '''Return the APOD date of a cached entry, None if unknown.'''
+        entry = self.entries.get(key)
+
+        if entry is None:
+            return None
+
+        return entry.get("date")
+
+    def validators(self, key):
+        '''Return conditional request headers for a cached entry.'''
+        entry = self.entries.get(key, {})
+        headers = {}
+
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+
+        if entry.get("last-modified"):
+            headers["If-Modified-Since"] = entry["last-modified"]
+
+        return headers
+
+    def touch(self, key):
+        '''Mark an entry as fresh after a 304 Not Modified.'''
+        entry = self.entries.get(key)
+
+        if entry is not None:
+            self.write([dict(entry, fetched=time.time())])
+
+    def set(self, key, text, status_code=200, headers=None):
+        '''
+        Store a response and its validators. Anything that is not an
+        image is reduced to a negative entry holding only the date and
+        media type.
+        '''
+        headers = headers or {}
+
+        try:
+            resp_dict = loads(text)
+
+        except decoder.JSONDecodeError:
+            return
+
+        if not isinstance(resp_dict, dict):
+            return
+
+        media_type = resp_dict.get("media_type", "none")
+
+        if status_code != 200 or media_type != "image":
+            media_type = media_type if status_code == 200 else "none"
+            text = dumps({"date": resp_dict.get("date", key),
+                          "media_type": media_type})
+
+        entries = [{"key": key, "fetched": time.time(), "status": status_code,
+                    "media_type": media_type, "text": text,
+                    "date": resp_dict.get("date", key),
+                    "etag": headers.get("ETag", ""),
+                    "last-modified": headers.get("Last-Modified", "")}]
+
+        # today's response is also stored under its own date for good.
+        if key == "today" and "date" in resp_dict:
+            entries.append(dict(entries[0], key=resp_dict["date"]))
+
+        self.write(entries)
+
+    def write(self, entries):
+        '''Add entries to the cache and append them to the cache file.'''
+        try:
+            with self.lock:
+                with open(self.cache_file, "a") as cache_file:
+                    for entry in entries:
+                        self.entries[entry["key"]] = entry
+                        cache_file.write(dumps(entry) + "\n")
+                        self.lines += 1
+
+                if self.lines - len(self.entries) > COMPACT_LINES:
+                    self.compact()
+
+        except (PermissionError, OSError) as error:
+            print(f"MetadataCache.write: {error}")
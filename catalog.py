@@ -0,0 +1,65 @@
+# -*- mode: python ; coding: utf-8 -*-
+'''
+Local catalog of APOD metadata. Holds one row per APOD date so random
+selection can run without asking the api. Filled and kept current by
+fetchAPOD.py sync.
+ '''
+
+import csv
+from pathlib import Path
+
+CATALOG_FIELDS = ["date", "title", "explanation", "url", "hdurl",
+                  "media_type", "copyright"]
+
+
+def catalog_path(DATA_FILE):
+    '''Return the path of the catalog next to the data file.'''
+    return Path(DATA_FILE).parent.joinpath("catalog.data")
+
+
+def read_catalog(CATALOG_FILE):
+    '''Read the catalog, return a list of dictionaries sorted by date.'''
+    try:
+        with open(CATALOG_FILE, "r", newline="") as catalog_file:
+            reader = csv.DictReader(catalog_file)
+            return sorted(reader, key=lambda item: item["date"])
+
+    except (FileNotFoundError, PermissionError, OSError):
+        return []
+
+    except (csv.Error, KeyError, UnicodeDecodeError) as error:
+        print(f"read_catalog: {error}")
+        return []
+
+
+def append_catalog(CATALOG_FILE, entries):
+    '''Append api entries to the catalog, write the header on a new file.'''
+    new_file = not Path(CATALOG_FILE).is_file()
+
+    try:
+        with open(CATALOG_FILE, "a", newline="") as catalog_file:
+            writer = csv.DictWriter(catalog_file,
+                                    fieldnames=CATALOG_FIELDS,
+                                    extrasaction="ignore"
+                                    )
+            if new_file:
+                writer.writeheader()
+
+            writer.writerows(entries)
+
+    except (csv.Error, PermissionError, OSError, UnicodeEncodeError) as error:
+        print(f"append_catalog: {error}")
+        return False
+
+    return True
+
+
+def newest_date(CATALOG_FILE):
+    '''Return the newest date in the catalog as a string, or None.'''
+    catalog = read_catalog(CATALOG_FILE)
+
+    if len(catalog) == 0:
+        return None
+
+    return catalog[-1]["date"]
+
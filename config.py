@@ -44,6 +44,18 @@ class SetupConfig:
             self.API_KEY = self.conf["API"]["API_KEY"]
             self.RESP_URL = self.conf["API"]["RESP_URL"]
 
+            # optional settings, fall back to defaults when missing.
+            self.PREFETCH = self.conf["GENERAL"].get("PREFETCH", 0)
+            self.ROTATE = self.conf["GENERAL"].get("ROTATE", "false")
+            network = self.conf.get("NETWORK", {})
+            self.POOL_SIZE = network.get("POOL_SIZE", 10)
+            self.RETRIES = network.get("RETRIES", 3)
+            self.BACKOFF = network.get("BACKOFF", 0.5)
+            self.HEDGE = network.get("HEDGE", 0)
+            self.WORKERS = self.conf["IMAGE"].get("WORKERS", 0)
+            self.CACHE_SIZE = self.conf["IMAGE"].get("CACHE_SIZE", 500)
+            self.MONITORS = self.conf["IMAGE"].get("MONITORS", "")
+
         except (ValueError, KeyError) as error:
             print("confing.py: {error}")
             raise SystemExit(1)
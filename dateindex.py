@@ -0,0 +1,156 @@
+# -*- mode: python ; coding: utf-8 -*-
+'''
+Compact index of every APOD date. Bitsets over the days since the first
+APOD mark known image dates, dates with other media and dates already in
+the library. The unowned image dates are kept in a pool so a random date
+is drawn in constant time, without replacement and without retries.
+The pool is shared by the prefetch, hedge and backfill threads, every
+change to it holds the index's lock.
+ '''
+
+import random
+import threading
+from array import array
+from datetime import date, timedelta
+
+FIRST_APOD = date(1995, 6, 16)
+# No APOD was published on the three days after the first one.
+MISSING_DAYS = {date(1995, 6, 17), date(1995, 6, 18), date(1995, 6, 19)}
+
+
+class DateIndex:
+    '''Bitsets and a sampling pool over the days from FIRST_APOD to last.'''
+
+    def __init__(self, last=None):
+        last = last or date.today()
+        self.days = max(0, (last - FIRST_APOD).days + 1)
+        size = (self.days + 7) // 8
+        self.image = bytearray(size)
+        self.other = bytearray(size)
+        self.owned = bytearray(size)
+        self.pool = array("l")
+        self.position = array("l", [-1]) * self.days
+        self.lock = threading.RLock()
+
+        for missing in MISSING_DAYS:
+            self.set_bit(self.other, self.offset(missing))
+
+    def offset(self, apod_date):
+        '''Return the day number of a date or YYYY-MM-DD string, or None.'''
+        if isinstance(apod_date, str):
+            try:
+                apod_date = date.fromisoformat(apod_date)
+
+            except ValueError:
+                return None
+
+        day = (apod_date - FIRST_APOD).days
+
+        if day < 0 or day >= self.days:
+            return None
+
+        return day
+
+    def set_bit(self, bits, day):
+        if day is not None:
+            bits[day >> 3] |= 1 << (day & 7)
+
+    def get_bit(self, bits, day):
+        return bool(bits[day >> 3] & (1 << (day & 7)))
+
+    def mark_image(self, apod_date):
+        with self.lock:
+            self.set_bit(self.image, self.offset(apod_date))
+
+    def mark_other(self, apod_date):
+        '''Mark a date as not an image and take it out of the pool.'''
+        day = self.offset(apod_date)
+
+        with self.lock:
+            self.set_bit(self.other, day)
+            self.remove(day)
+
+    def mark_owned(self, apod_date):
+        '''Mark a date as in the library and take it out of the pool.'''
+        day = self.offset(apod_date)
+
+        with self.lock:
+            self.set_bit(self.owned, day)
+            self.remove(day)
+
+    def is_candidate(self, apod_date):
+        '''Return True if a date is not owned and not known to be other media.'''
+        day = self.offset(apod_date)
+
+        if day is None:
+            return False
+
+        return not (self.get_bit(self.owned, day)
+                    or self.get_bit(self.other, day))
+
+    def build_pool(self, images_only=True):
+        '''
+        Fill the pool with every candidate date. With images_only only
+        dates known to be images are added, otherwise unknown dates too.
+        '''
+        pool = array("l")
+        position = array("l", [-1]) * self.days
+
+        with self.lock:
+            for day in range(self.days):
+                if (self.get_bit(self.owned, day)
+                        or self.get_bit(self.other, day)):
+                    continue
+
+                if images_only and not self.get_bit(self.image, day):
+                    continue
+
+                position[day] = len(pool)
+                pool.append(day)
+
+            self.pool = pool
+            self.position = position
+
+    def remove(self, day):
+        '''Swap a day out of the pool in constant time.'''
+        with self.lock:
+            if day is None or self.position[day] == -1:
+                return
+
+            index = self.position[day]
+            last = self.pool[-1]
+            self.pool[index] = last
+            self.position[last] = index
+            self.pool.pop()
+            self.position[day] = -1
+
+    def restore(self, apod_date):
+        '''
+        Put a drawn date back in the pool, for a download that failed
+        for a passing reason. Owned and other media dates stay out.
+        '''
+        day = self.offset(apod_date)
+
+        with self.lock:
+            if day is None or self.position[day] != -1:
+                return
+
+            if not self.is_candidate(apod_date):
+                return
+
+            self.position[day] = len(self.pool)
+            self.pool.append(day)
+
+    def draw(self):
+        '''Remove and return a random date from the pool, None if empty.'''
+        with self.lock:
+            if len(self.pool) == 0:
+                return None
+
+            day = self.pool[random.randrange(len(self.pool))]
+            self.remove(day)
+
+        return FIRST_APOD + timedelta(days=day)
+
+    def __len__(self):
+        return len(self.pool)
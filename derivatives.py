@@ -0,0 +1,300 @@
+# -*- mode: python ; coding: utf-8 -*-
+'''
+On demand variants of library images, such as gallery thumbnails at the
+screen's pixel ratio, wallpapers sized to a monitor and crops to a ratio.
+A variant is rendered once and kept on disk, keyed by a hash of the
+source image and the variant's size, fit and format, so asking for it
+again costs no decode or encode. The least recently used variants are
+deleted to keep the cache within its disk budget. The gui, the command
+line and the backfill may share the cache, each merges the index saved by
+the others under a file lock before evicting or saving.
+ '''
+
+import os
+import time
+import hashlib
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from json import loads, dumps, decoder
+
+from PIL import Image, ImageOps
+
+from pipeline import fast_thumbnail, REDUCING_GAP
+from storage import FileLock
+
+# Disk budget in megabytes used when none is configured.
+DERIVATIVE_BUDGET = 500
+FORMATS = {"JPEG": "jpg", "PNG": "png", "WEBP": "webp"}
+HASH_BLOCK = 1024 * 1024
+# Seconds between index saves when only the use order changed.
+SAVE_INTERVAL = 30
+# Seconds before a temporary file left by a crashed render is deleted.
+TEMP_AGE = 3600
+
+
+def derivative_path(DATA_FILE):
+    '''Return the path of the derivative cache next to the data file.'''
+    return Path(DATA_FILE).parent.joinpath("derivatives")
+
+
+def file_hash(file):
+    '''Return the sha256 of a file's content.'''
+    digest = hashlib.sha256()
+
+    with open(file, "rb") as source:
+        for block in iter(lambda: source.read(HASH_BLOCK), b""):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def render(source, variants, fit, image_format):
+    '''
+    Render (target, size) variants of source from one decode. With fit an
+    image is scaled to fit within size, otherwise it is cropped around its
+    center to the ratio of size and scaled to exactly size.
+    '''
+    with Image.open(source) as image:
+        if fit:
+            largest = (max(size[0] for target, size in variants),
+                       max(size[1] for target, size in variants))
+            image.draft("RGB", (largest[0] * REDUCING_GAP,
+                                largest[1] * REDUCING_GAP))
+
+        else:
+            scale = max(max(size[0] / image.width, size[1] / image.height)
+                        for target, size in variants)
+            image.draft("RGB", (int(image.width * scale * REDUCING_GAP),
+                                int(image.height * scale * REDUCING_GAP)))
+
+        icc_profile = image.info.get("icc_profile")
+        pixels = image.convert("RGB")
+
+        for target, size in variants:
+            if fit:
+                variant = fast_thumbnail(pixels, size)
+
+            else:
+                variant = ImageOps.fit(pixels, size, Image.Resampling.LANCZOS)
+
+            variant.save(target,
+                         format=image_format,
+                         quality=95,
+                         optimize=True,
+                         icc_profile=icc_profile
+                         )
+
+
+class DerivativeCache:
+    '''
+    Variants stored in CACHE_DIR with an index of their sizes in least
+    recently used order. Safe to share across threads and processes.
+    '''
+
+    def __init__(self, CACHE_DIR, budget=DERIVATIVE_BUDGET):
+        self.cache_dir = Path(CACHE_DIR)
+        self.index_file = self.cache_dir.joinpath("index.json")
+        self.budget = int(budget) * 1024 * 1024
+        self.lock = threading.Lock()
+        self.file_lock = FileLock(self.cache_dir.joinpath("index.lock"))
+        self.saved = 0.0
+        self.entries, self.sources, self.pinned = self.load()
+
+    def load(self):
+        '''Return the entries, sources and pinned keys of the saved index.'''
+        try:
+            with open(self.index_file, "r") as index_file:
+                index = loads(index_file.read())
+
+            entries = OrderedDict(sorted(index["entries"].items(),
+                                         key=lambda item: item[1]["used"]))
+            return entries, index["sources"], index.get("pinned", [])
+
+        except FileNotFoundError:
+            pass
+
+        except (PermissionError, OSError, decoder.JSONDecodeError,
+                KeyError, TypeError) as error:
+            print(f"DerivativeCache.load: {error}")
+
+        return OrderedDict(), {}, []
+
+    def merge(self, pin=None):
+        '''
+        Merge the saved index into this one, hold the file lock. Variants
+        whose file is gone are dropped, variant files no index recorded are
+        taken in and temporary files of crashed renders are deleted. The
+        pinned keys are the saved ones unless pin replaces them.
+        '''
+        entries, sources, pinned = self.load()
+
+        for key, entry in self.entries.items():
+            if key not in entries or entries[key]["used"] < entry["used"]:
+                entries[key] = entry
+
+        sources.update(self.sources)
+        files = set()
+
+        for file in self.cache_dir.iterdir():
+            try:
+                stat = file.stat()
+
+                if file.name.startswith("tmp-"):
+                    if time.time() - stat.st_mtime > TEMP_AGE:
+                        os.remove(file)
+
+                elif file.suffix[1:] in FORMATS.values():
+                    files.add(file.name)
+
+                    if file.name not in entries:
+                        entries[file.name] = {"file": file.name,
+                                              "size": stat.st_size,
+                                              "used": stat.st_mtime}
+
+            except FileNotFoundError:
+                pass
+
+        self.entries = OrderedDict(sorted(
+                ((key, entry) for key, entry in entries.items()
+                 if entry["file"] in files),
+                key=lambda item: item[1]["used"]))
+        self.sources = sources
+        self.pinned = pinned if pin is None else list(pin)
+
+    def save(self):
+        try:
+            temp_file = self.index_file.with_suffix(".tmp")
+
+            with open(temp_file, "w") as index_file:
+                index_file.write(dumps({"entries": self.entries,
+                                        "sources": self.sources,
+                                        "pinned": self.pinned}))
+
+            os.replace(temp_file, self.index_file)
+            self.saved = time.time()
+
+        except (PermissionError, OSError) as error:
+            print(f"DerivativeCache.save: {error}")
+
+    def sync(self, keep=(), pin=None):
+        '''Merge the saved index, evict down to budget and save it.'''
+        try:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+            with self.file_lock:
+                self.merge(pin)
+                self.evict(keep)
+                self.save()
+
+        except (PermissionError, OSError) as error:
+            print(f"DerivativeCache.sync: {error}")
+
+    def source_hash(self, source):
+        '''Return the hash of a source, rehashed only when it changed.'''
+        stat = os.stat(source)
+        stamp = [stat.st_mtime_ns, stat.st_size]
+        known = self.sources.get(str(source))
+
+        if known is not None and known["stamp"] == stamp:
+            return known["hash"]
+
+        digest = file_hash(source)
+        self.sources[str(source)] = {"stamp": stamp, "hash": digest}
+        return digest
+
+    def get(self, source, width, height, fit=True, image_format="JPEG"):
+        '''
+        Return the path of a width x height variant of source, rendering
+        it first if it is not cached. Raises OSError if source can not be
+        read or rendered.
+        '''
+        return self.get_many(source, [(width, height)], fit, image_format)[0]
+
+    def get_many(self, source, sizes, fit=True, image_format="JPEG",
+                 pin=False):
+        '''
+        Return the paths of variants of source in several sizes, the
+        missing ones are rendered from a single decode. Pinned variants
+        are never evicted, pinning unpins the ones pinned before.
+        '''
+        image_format = image_format.upper()
+        extension = FORMATS[image_format]
+        sizes = [(int(width), int(height)) for width, height in sizes]
+
+        with self.lock:
+            digest = self.source_hash(source)
+
+        keys = [f"{digest[:32]}-{width}x{height}-{'fit' if fit else 'fill'}"
+                + f".{extension}" for width, height in sizes]
+        targets = [self.cache_dir.joinpath(key) for key in keys]
+        missing = []
+
+        with self.lock:
+            for key, target, size in zip(keys, targets, sizes):
+                if key in self.entries and target.is_file():
+                    self.entries.move_to_end(key)
+                    self.entries[key]["used"] = time.time()
+
+                elif (target, size) not in missing:
+                    missing.append((target, size))
+
+        if len(missing) != 0:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+            temp_targets = [(target.with_name(f"tmp-{target.name}"), size)
+                            for target, size in missing]
+
+            try:
+                render(source, temp_targets, fit, image_format)
+
+                for (temp_target, size), (target, size) in zip(temp_targets,
+                                                               missing):
+                    os.replace(temp_target, target)
+
+            except BaseException:
+                for temp_target, size in temp_targets:
+                    try:
+                        os.remove(temp_target)
+
+                    except OSError:
+                        pass
+
+                raise
+
+        with self.lock:
+            for target, size in missing:
+                self.entries[target.name] = {"file": target.name,
+                                             "size": target.stat().st_size,
+                                             "used": time.time()}
+
+            if (len(missing) != 0 or pin
+                    or time.time() - self.saved > SAVE_INTERVAL):
+                self.sync(keys, keys if pin else None)
+
+        return targets
+
+    def evict(self, keep=()):
+        '''
+        Delete least recently used variants until within budget. Pinned
+        variants and the keys in keep are not deleted.
+        '''
+        total = sum(entry["size"] for entry in self.entries.values())
+
+        for key in list(self.entries):
+            if total <= self.budget:
+                break
+
+            if key in keep or key in self.pinned:
+                continue
+
+            entry = self.entries.pop(key)
+            total -= entry["size"]
+
+            try:
+                os.remove(self.cache_dir.joinpath(entry["file"]))
+
+            except FileNotFoundError:
+                pass
+
+            except (PermissionError, OSError) as error:
+                print(f"DerivativeCache.evict: {error}")
@@ -12,6 +12,7 @@ from webbrowser import open_new_tab
 from random import randint
 
 from PyQt6.QtCore import (Qt, pyqtSlot, QAbstractTableModel, QSize, QEvent,
+                          pyqtSignal, QObject,
                           QSortFilterProxyModel, QSettings, QMimeData, QRunnable,
                            QThreadPool, QMutex, QThread, QTimer, QCoreApplication,
                            QPoint)
@@ -29,10 +30,15 @@ from fetchAPOD import (test_connection, generate_data, formulate_data,
                       gen_year, test_valid, make_url, verify_dimensions,
                       create_thumbnail, crop_image, check_data_header,
                       write_data_header, append_data, write_data_rows,
-                      read_data_rows, sort_categories, dir_cleanup,
-                      delete_file, reset_field_dict)
+                      read_data_rows, read_records, read_latest_row,
+                      read_latest_record, dir_cleanup,
+                      delete_file, reset_field_dict, init_session,
+                      init_cache, init_prefetch, init_hedge,
+                      init_derivatives, get_derivative, init_monitors)
 from fetchAPOD import main as main_cli
+from monitors import Monitor
 from config import SetupConfig
+from cache import cache_path
 from ui_main import Ui_MainWindow
 import qdarktheme
 
@@ -170,6 +176,17 @@ class GUI(QMainWindow, Ui_MainWindow):
             self.CUSTOM_ENV = self.envvar_lineedit.text()
             self.TIME_INTERVAL_GUI = self.timeinterval_spinbox.value()
             self.REDOWNLOAD = conf.REDOWNLOAD
+            self.ROTATE = conf.ROTATE
+            init_session(conf.POOL_SIZE, conf.RETRIES, conf.BACKOFF)
+            init_cache(cache_path(self.DATA_FILE))
+            init_derivatives(self.DATA_FILE, conf.CACHE_SIZE)
+            self.MONITORS = conf.MONITORS
+            self.init_monitors()
+            init_hedge(conf.HEDGE)
+            init_prefetch(conf.PREFETCH, self.DATA_FILE, self.FIELD_NAMES,
+                          self.IMAGE_DIR, self.TIMG_DIR, self.QUALITY,
+                          self.API_KEY, self.REDOWNLOAD, self.MIN_SIZE,
+                          self.CROP_RATIO, self.field_dict)
 
         except (AttributeError, TypeError):
             pass
@@ -281,7 +298,8 @@ class GUI(QMainWindow, Ui_MainWindow):
         # init qtimer and connect signals
         self.fetch_timer = QTimer(self)
         self.fetch_timer.timeout.connect(
-                lambda: self.start_thread(self.fetchapod("true", None, "false"))
+                lambda: self.start_thread(
+                    self.fetchapod("true", None, "false", True))
                 )
         self.timeinterval_spinbox.valueChanged.connect(
                 lambda: self.start_thread_interval()
@@ -430,12 +448,16 @@ class GUI(QMainWindow, Ui_MainWindow):
 
     def setwallpaper_current(self):
         self.mutex.lock()
-        row = read_data_rows(self.DATA_FILE, self.FIELD_NAMES)[-1]
-        set_background(self.IMAGE_DIR, self.QUALITY, self.CUSTOM_CMD,
-                       self.CUSTOM_ENV, row)
+        row = read_latest_row(self.DATA_FILE, self.FIELD_NAMES)
+
+        if row is not None:
+            set_background(self.IMAGE_DIR, self.QUALITY, self.CUSTOM_CMD,
+                           self.CUSTOM_ENV, row)
+
         self.mutex.unlock()
 
-    def fetchapod(self, setwallpaper, resp_url=None, redownload="false"):
+    def fetchapod(self, setwallpaper, resp_url=None, redownload="false",
+                  conditional=False):
         # run fetchAPOD main() imported as main_cli(), then get the most
         # recent entry in data file.
         self.mutex.lock()
@@ -461,21 +483,26 @@ class GUI(QMainWindow, Ui_MainWindow):
                  self.CROP_SAVE, self.TMP_SAVE, self.QUALITY,
                  self.MIN_SIZE, self.CROP_RATIO, self.API_KEY,
                  self.CUSTOM_CMD, self.CUSTOM_ENV, setwallpaper,
-                 resp_url, "0", redownload, self.field_dict)
+                 resp_url, "0", redownload, self.field_dict, conditional,
+                 self.ROTATE.lower() == "true")
 
-        row = read_data_rows(self.DATA_FILE, self.FIELD_NAMES)[-1]
+        record = read_latest_record(self.DATA_FILE, self.FIELD_NAMES)
         self.mutex.unlock()
 
+        # nothing was fetched into an empty data file.
+        if record is None:
+            return
+
         # format tooltip text
-        html = row["html"]
-        file = Path(self.IMAGE_DIR).joinpath(row["filename"])
+        html = record.html
+        file = Path(self.IMAGE_DIR).joinpath(record.filename)
 
-        tooltip = (f'{row["title"]} - {row["copyright"]}\n'
-                 + f'{row["date"]}\n\n'
-                 + f'{row["explanation"]}\n\n'
+        tooltip = (f'{record.title} - {record.copyright}\n'
+                 + f'{record.date_text()}\n\n'
+                 + f'{record.explanation}\n\n'
                  +  'Dimensions:\n\n'
-                 + f'{row["img-WxH"]}\n'
-                 + f'Size: {row["img-size"]}'
+                 + f'{record.dimensions()}\n'
+                 + f'Size: {record.size_text()}'
                    )
 
         self.view.pixmap = QPixmap(str(file))
@@ -488,23 +515,35 @@ class GUI(QMainWindow, Ui_MainWindow):
         self.init_gallery()
         try:
             self.mutex.lock()
-            self.apod_data = read_data_rows(self.DATA_FILE,
-                                            self.FIELD_NAMES)[1:]
-
-            for num, row in enumerate(self.apod_data):
-                tooltip = (f'{row["title"]} - {row["copyright"]}\n'
-                         + f'{row["date"]}\n\n'
-                         + f'{row["explanation"]}\n\n'
+            self.apod_data = read_records(self.DATA_FILE, self.FIELD_NAMES)
+            # thumbnails are 310px, sharper ones are made for hidpi
+            # screens while the original image is still saved. they are
+            # rendered on a worker, the thumbnail is shown until then.
+            timg_size = ceil(310 * self.devicePixelRatio())
+            sharper = []
+
+            for num, record in enumerate(self.apod_data):
+                tooltip = (f'{record.title} - {record.copyright}\n'
+                         + f'{record.date_text()}\n\n'
+                         + f'{record.explanation}\n\n'
                          +  'Dimensions:\n\n'
-                         + f'{row["img-WxH"]}\n'
-                         + f'Size: {row["img-size"]}'
+                         + f'{record.dimensions()}\n'
+                         + f'Size: {record.size_text()}'
                            )
 
-                image = QImage(str(self.TIMG_DIR.joinpath(row["filename"])))
-                item = self.image_data(num, tooltip, image, row["html"])
+                timg_file = self.TIMG_DIR.joinpath(record.filename)
+                image_file = Path(self.IMAGE_DIR).joinpath(record.filename)
+
+                if timg_size > 310 and image_file.is_file():
+                    sharper.append((num, image_file))
+
+                image = QImage(str(timg_file))
+                item = self.image_data(num, tooltip, image, record.html)
                 self.gallery_model.image_data.append(item)
                 self.resizeEvent(event=None)
 
+            self.start_derivatives(sharper, timg_size)
+
         except (TypeError, AttributeError, IndexError) as error:
             print(f"populate_gallery: {error}")
             pass
@@ -514,6 +553,38 @@ class GUI(QMainWindow, Ui_MainWindow):
         self.gallery_tableview.resizeColumnsToContents()
         self.gallery_model.layoutChanged.emit()
 
+    def start_derivatives(self, items, size):
+        # render the sharper thumbnails of the gallery in the background,
+        # stopping the ones still running for a previous gallery.
+        if getattr(self, "derivative_worker", None) is not None:
+            self.derivative_worker.cancelled = True
+
+        self.derivative_worker = None
+
+        if len(items) == 0:
+            return
+
+        worker = DerivativeWorker(items, size, self.gallery_model)
+        worker.signals.ready.connect(self.set_gallery_image)
+        self.derivative_worker = worker
+        QThreadPool.globalInstance().start(worker)
+
+    def set_gallery_image(self, model, num, image):
+        # swap a thumbnail for its sharper copy once it is rendered.
+        if model is not self.gallery_model or image.isNull():
+            return
+
+        try:
+            item = model.image_data[num]._replace(image=image)
+            model.image_data[num] = item
+
+        except IndexError:
+            return
+
+        index = model.index(num // model.table_columns,
+                            num % model.table_columns)
+        model.dataChanged.emit(index, index)
+
     def init_fetch_timer(self):
         # initiate run on time interval if not 0.
         if self.timeinterval_spinbox.value() != 0:
@@ -567,6 +638,30 @@ class GUI(QMainWindow, Ui_MainWindow):
             Qt.ContextMenuPolicy.CustomContextMenu)
         self.gallery_tableview.customContextMenuRequested.connect(delegate.contextMenuEvent)
 
+    def init_monitors(self):
+        # render wallpapers for the screens qt reports, in device pixels,
+        # unless MONITORS is set. follow screens being added or removed.
+        if init_monitors(self.MONITORS) is not None:
+            return
+
+        app = QApplication.instance()
+        screens = [app.primaryScreen()] + [
+                screen for screen in app.screens()
+                if screen != app.primaryScreen()]
+        init_monitors([Monitor(screen.name(),
+                               round(screen.geometry().width()
+                                     * screen.devicePixelRatio()),
+                               round(screen.geometry().height()
+                                     * screen.devicePixelRatio()))
+                       for screen in screens if screen is not None])
+
+        if not getattr(self, "monitors_connected", False):
+            app.screenAdded.connect(lambda screen: self.init_monitors())
+            app.screenRemoved.connect(lambda screen: self.init_monitors())
+            app.primaryScreenChanged.connect(
+                    lambda screen: self.init_monitors())
+            self.monitors_connected = True
+
     def init_systray(self):
         # system tray
         tray_icon = QIcon(
@@ -907,17 +1002,18 @@ class DelegateData(QStyledItemDelegate):
         width = option.rect.width() - cell_padding * 2
         height = option.rect.height() - cell_padding * 2
 
+        # scale to device pixels so hidpi thumbnails stay sharp.
         scaled = self.data.image.scaled(
-                width,
-                height,
+                ceil(width * dpi),
+                ceil(height * dpi),
                 aspectRatioMode=Qt.AspectRatioMode.KeepAspectRatio
                 )
+        scaled.setDevicePixelRatio(dpi)
 
         # position in the middle of area and paint it
-        x = cell_padding + (width - scaled.width()) / 2
-        y = cell_padding + (height - scaled.height())
+        x = cell_padding + (width - scaled.width() / dpi) / 2
+        y = cell_padding + (height - scaled.height() / dpi)
 
-        scaled.setDevicePixelRatio(dpi)
         painter.drawImage(
                 ceil(option.rect.x() + x),
                 ceil(option.rect.y() + y), scaled
@@ -1062,6 +1158,33 @@ class Threaded(QRunnable):
         self.fn
 
 
+class DerivativeSignals(QObject):
+    ready = pyqtSignal(object, int, QImage)
+
+
+class DerivativeWorker(QRunnable):
+    '''Render sharper gallery thumbnails off the gui thread.'''
+    def __init__(self, items, size, model):
+        super(DerivativeWorker, self).__init__()
+        self.items = items
+        self.size = size
+        self.model = model
+        self.cancelled = False
+        self.signals = DerivativeSignals()
+
+    @pyqtSlot()
+    def run(self):
+        for num, image_file in self.items:
+            if self.cancelled:
+                return
+
+            timg_file = get_derivative(image_file, self.size, self.size)
+
+            if timg_file is not None and not self.cancelled:
+                self.signals.ready.emit(self.model, num,
+                                        QImage(str(timg_file)))
+
+
 def main():
     gui = GUI()
     qdarktheme.setup_theme(custom_colors={"primary": "#818aab"},
@@ -9,18 +9,74 @@ import sys
 import os
 import subprocess
 import random
+import calendar
 import re
 import csv
+import sqlite3
 import ctypes
 import time
+import shlex
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from datetime import datetime
-from json import loads, decoder
+from urllib.parse import urlparse, parse_qs
+from datetime import datetime, date, timedelta
+from json import loads, dumps, decoder
 
-from PIL import Image
+from PIL import ImageFile
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from config import SetupConfig
+from catalog import catalog_path, append_catalog, newest_date, read_catalog
+from cache import MetadataCache, cache_path
+from ratelimit import RateLimiter, RATE_MAX_WAIT, RATE_INTERACTIVE_WAIT
+from prefetch import PrefetchQueue, prefetch_path
+from dateindex import DateIndex, FIRST_APOD, MISSING_DAYS
+from storage import get_storage, CSVStorage
+from record import ApodRecord, Category
+from pipeline import ImagePipeline, crop_box
+from imagepool import image_job, process_images, crop_path
+from derivatives import DerivativeCache, derivative_path
+from monitors import parse_monitors, detect_monitors
+
+# Shared requests session, see init_session().
+SESSION = None
+# Shared api response cache, see init_cache().
+METADATA_CACHE = None
+# Paces every request to api.nasa.gov to stay inside the key's quota.
+RATE_LIMITER = RateLimiter()
+# Buffer of prepared random APODs, see init_prefetch().
+PREFETCH_QUEUE = None
+# Resized variants of library images, see init_derivatives().
+DERIVATIVES = None
+# Monitors wallpapers are rendered for, see init_monitors().
+MONITORS = None
+# Random candidates downloaded side by side, see init_hedge(). 0 is off.
+HEDGE = 0
+# Filenames being downloaded right now, see download_apod().
+DOWNLOADING = set()
+DOWNLOADING_LOCK = threading.Lock()
+# Index of image, other media and owned dates, see get_date_index().
+DATE_INDEX = None
+# Owned filenames and dates of the data file, see get_library_index().
+LIBRARY_INDEX = None
+# Random entries requested per call, and calls made before giving up.
+RANDOM_BATCH = 10
+BATCH_ATTEMPTS = 3
+# Entries of the last random batch not drawn yet, see random_entries().
+RANDOM_BUFFER = []
+RANDOM_BUFFER_LOCK = threading.Lock()
+# Days of metadata requested per call when syncing the catalog.
+CATALOG_CHUNK = 180
+# Bytes read from the response and written to disk at a time.
+CHUNK_SIZE = 64 * 1024
+# Bytes written between updates of a partial download's sidecar file.
+PART_SYNC_SIZE = 1024 * 1024
+# Bytes fed to the header parser before giving up on early size checks.
+PROBE_SIZE = 1024 * 1024
 
 
 def init_variables():
@@ -40,17 +96,29 @@ def init_variables():
     CUSTOM_CMD = conf.CUSTOM_CMD
     CUSTOM_ENV = conf.CUSTOM_ENV
     API_KEY = conf.API_KEY
-    RESP_URL = conf.RESP_URL + API_KEY
+    RESP_URL = conf.RESP_URL
     SET_WALLPAPER = conf.SET_WALLPAPER
     TIME_INTERVAL = conf.TIME_INTERVAL
     field_dict = conf.field_dict
     TIME_INTERVAL = int(TIME_INTERVAL) * 60
     REDOWNLOAD = conf.REDOWNLOAD
 
+    init_session(conf.POOL_SIZE, conf.RETRIES, conf.BACKOFF)
+    init_cache(cache_path(DATA_FILE))
+    init_hedge(conf.HEDGE)
+    init_derivatives(DATA_FILE, conf.CACHE_SIZE)
+    init_monitors(conf.MONITORS)
+    init_prefetch(conf.PREFETCH, DATA_FILE, FIELD_NAMES, IMAGE_DIR, TIMG_DIR,
+                  QUALITY, API_KEY, REDOWNLOAD, MIN_SIZE, CROP_RATIO,
+                  field_dict)
     main(FIELD_NAMES, IMAGE_DIR, TIMG_DIR, DATA_FILE, ORIG_SAVE, TIMG_SAVE,
          CROP_SAVE, TMP_SAVE, QUALITY, MIN_SIZE, CROP_RATIO, API_KEY,
          CUSTOM_CMD, CUSTOM_ENV, SET_WALLPAPER, RESP_URL, TIME_INTERVAL,
-         REDOWNLOAD, field_dict)
+         REDOWNLOAD, field_dict, rotate=conf.ROTATE.lower() == "true")
+
+    # let a one shot run finish refilling the buffer before exiting.
+    if PREFETCH_QUEUE is not None:
+        PREFETCH_QUEUE.join()
 
     return (FIELD_NAMES, IMAGE_DIR, TIMG_DIR, DATA_FILE, ORIG_SAVE, TIMG_SAVE,
             CROP_SAVE, TMP_SAVE, QUALITY, MIN_SIZE, CROP_RATIO, API_KEY,
@@ -58,15 +126,235 @@ def init_variables():
             REDOWNLOAD, field_dict)
 
 
-def test_connection(RESP_URL):
+def init_session(POOL_SIZE=10, RETRIES=3, BACKOFF=0.5):
+    '''
+    Create the shared session used for every request. Connections to
+    api.nasa.gov and apod.nasa.gov are kept alive and reused from the
+    pool, transient failures are retried by the adapter.
+    '''
+    global SESSION
+
+    retry = Retry(total=int(RETRIES),
+                  backoff_factor=float(BACKOFF),
+                  status_forcelist=(500, 502, 503, 504),
+                  allowed_methods=("GET", "HEAD")
+                  )
+    adapter = HTTPAdapter(pool_connections=4,
+                          pool_maxsize=int(POOL_SIZE),
+                          max_retries=retry
+                          )
+
+    if SESSION is not None:
+        SESSION.close()
+
+    SESSION = requests.Session()
+    SESSION.headers.update({"Connection": "keep-alive"})
+    SESSION.mount("https://", adapter)
+    SESSION.mount("http://", adapter)
+    return SESSION
+
+
+def get_session():
+    '''Return the shared session, create it with defaults if needed.'''
+    if SESSION is None:
+        return init_session()
+
+    return SESSION
+
+
+def init_cache(CACHE_FILE):
+    '''
+    Load the api response cache. test_connection serves metadata lookups
+    from it once loaded.
+    '''
+    global METADATA_CACHE
+
+    METADATA_CACHE = MetadataCache(CACHE_FILE)
+    return METADATA_CACHE
+
+
+def init_derivatives(DATA_FILE, CACHE_SIZE):
+    '''Load the derivative cache used by get_derivative.'''
+    global DERIVATIVES
+
+    DERIVATIVES = DerivativeCache(derivative_path(DATA_FILE), CACHE_SIZE)
+    return DERIVATIVES
+
+
+def get_derivative(image_path, width, height, fit=True, image_format="JPEG"):
+    '''
+    Return the path of a width x height variant of an image, rendered on
+    first use. With fit it fits within the size, otherwise it is cropped
+    to fill it. Return None if the variant could not be made.
+    '''
+    if DERIVATIVES is None:
+        return None
+
+    try:
+        return DERIVATIVES.get(image_path, width, height, fit, image_format)
+
+    except (FileNotFoundError, PermissionError, OSError, ValueError,
+            KeyError) as error:
+        print(f"get_derivative: {error}")
+        return None
+
+
+def init_monitors(monitors=""):
+    '''
+    Set the monitors wallpapers are rendered for, a MONITORS setting or a
+    list of Monitor. Left empty they are detected on first use.
+    '''
+    global MONITORS
+
+    if isinstance(monitors, str):
+        monitors = parse_monitors(monitors)
+
+    MONITORS = list(monitors) or None
+    return MONITORS
+
+
+def get_monitors():
+    '''Return the monitors, detect them if none were set.'''
+    global MONITORS
+
+    if MONITORS is None:
+        MONITORS = detect_monitors()
+
+    return MONITORS
+
+
+def render_wallpapers(image_path):
+    '''
+    Return (monitor, path) pairs of an image cropped and scaled to the
+    size of each monitor, rendered in one pass from a single decode and
+    pinned in the derivative cache while they are the wallpaper. Return
+    the image itself for every monitor if they can not be made.
+    '''
+    monitors = get_monitors()
+
+    if DERIVATIVES is None or len(monitors) == 0:
+        return [(None, image_path)]
+
+    try:
+        paths = DERIVATIVES.get_many(image_path,
+                                     [(monitor.width, monitor.height)
+                                      for monitor in monitors],
+                                     fit=False,
+                                     pin=True
+                                     )
+
+    except (FileNotFoundError, PermissionError, OSError, ValueError,
+            KeyError) as error:
+        print(f"render_wallpapers: {error}")
+        return [(None, image_path)]
+
+    return list(zip(monitors, paths))
+
+
+def cache_key(RESP_URL):
+    '''
+    Return the cache key of an api url, the requested date or "today".
+    Return None for urls that are not single date metadata lookups.
+    '''
+    url = urlparse(RESP_URL)
+    query = parse_qs(url.query)
+
+    if url.netloc != "api.nasa.gov" or not url.path.startswith(
+            "/planetary/apod"):
+        return None
+
+    if "count" in query or "start_date" in query:
+        return None
+
+    return query.get("date", ["today"])[0]
+
+
+def cache_entries(entries):
+    '''Add api entries from a batch or range request to the cache.'''
+    if METADATA_CACHE is None:
+        return
+
+    for entry in entries:
+        if (isinstance(entry, dict) and "date" in entry
+                and METADATA_CACHE.media_type(entry["date"]) is None):
+            METADATA_CACHE.set(entry["date"], dumps(entry))
+
+
+def init_sync():
+    '''Initiate config variables and sync the local catalog.'''
+    conf = SetupConfig()
+    init_session(conf.POOL_SIZE, conf.RETRIES, conf.BACKOFF)
+    init_cache(cache_path(conf.DATA_FILE))
+    sync_catalog(conf.API_KEY, catalog_path(conf.DATA_FILE))
+
+
+def init_regenerate(command):
+    '''Initiate config variables and rebuild the thumbnails or crops.'''
+    conf = SetupConfig()
+    check_folders_exist(conf.IMAGE_DIR, conf.TIMG_DIR)
+    written = regenerate_images(conf.DATA_FILE, conf.FIELD_NAMES,
+                                conf.IMAGE_DIR, conf.TIMG_DIR, conf.MIN_SIZE,
+                                conf.CROP_RATIO, conf.WORKERS,
+                                thumbnails=command == "thumbnails",
+                                crops=command == "crops")
+    print(f"init_regenerate: {written} {command} regenerated")
+
+
+def init_transfer(command, CSV_FILE):
+    '''Initiate config variables and export or import the data file.'''
+    conf = SetupConfig()
+    check_data_exists(conf.DATA_FILE)
+    check_data_header(conf.DATA_FILE, conf.FIELD_NAMES)
+
+    if command == "export":
+        export_data(conf.DATA_FILE, conf.FIELD_NAMES, CSV_FILE)
+
+    else:
+        import_data(conf.DATA_FILE, conf.FIELD_NAMES, CSV_FILE)
+
+
+def test_connection(RESP_URL, headers=None, max_wait=RATE_INTERACTIVE_WAIT):
     '''
     Test network connection. Return the response or handle the
-    exceptions.
+    exceptions. All attempts together wait at most max_wait seconds for
+    the rate limit, bulk callers pass RATE_MAX_WAIT.
     '''
+    key = None
+
+    if METADATA_CACHE is not None and headers is None:
+        key = cache_key(RESP_URL)
+
+    if key is not None:
+        cached = METADATA_CACHE.get(key)
+
+        if cached is not None:
+            return cached
+
+    limited = urlparse(RESP_URL).netloc == "api.nasa.gov"
+    deadline = time.monotonic() + max_wait
+
     for attempt in range(4):
+        if limited and not RATE_LIMITER.acquire(
+                max(0.0, deadline - time.monotonic())):
+            return
+
         try:
-            resp = requests.get(RESP_URL, timeout=(12.2, 30), stream=True)
+            resp = get_session().get(RESP_URL, timeout=(12.2, 30),
+                                     stream=True, headers=headers)
             attempt += 1
+
+            if limited:
+                RATE_LIMITER.update(resp)
+
+                # acquire() waits out the Retry-After, then try again.
+                if resp.status_code == 429:
+                    print("test_connection: 429 Too Many Requests")
+                    resp.close()
+                    continue
+
+            if key is not None and resp.status_code in (200, 404):
+                METADATA_CACHE.set(key, resp.text, resp.status_code,
+                                   resp.headers)
             return resp
 
         except (requests.exceptions.Timeout,
@@ -80,6 +368,45 @@ def test_connection(RESP_URL):
             return
 
 
+def poll_connection(RESP_URL):
+    '''
+    Poll an api url with a conditional request using the ETag and
+    Last-Modified of the last response. Return the response if it changed,
+    None if it is unchanged, still fresh in the cache, or on an error.
+    '''
+    key = None
+
+    if METADATA_CACHE is not None:
+        key = cache_key(RESP_URL)
+
+    if key is None:
+        return test_connection(RESP_URL)
+
+    if METADATA_CACHE.get(key) is not None:
+        return None
+
+    last_date = METADATA_CACHE.date(key)
+    resp = test_connection(RESP_URL, METADATA_CACHE.validators(key))
+
+    if resp is None:
+        return None
+
+    if resp.status_code == 304:
+        METADATA_CACHE.touch(key)
+        return None
+
+    if resp.status_code != 200:
+        return resp
+
+    METADATA_CACHE.set(key, resp.text, resp.status_code, resp.headers)
+
+    # no validators from the server, compare the APOD date instead.
+    if last_date is not None and METADATA_CACHE.date(key) == last_date:
+        return None
+
+    return resp
+
+
 def generate_data(API_KEY):
     '''
     Run nessicary funtions to generate a random date and url. Return
@@ -88,24 +415,125 @@ def generate_data(API_KEY):
     rand_month = gen_month()
     rand_year = gen_year()
     rand_day = gen_day(rand_month, rand_year)
-    test_valid(rand_day, rand_month, rand_year)
+    rand_year, rand_month, rand_day = test_valid(rand_day, rand_month,
+                                                 rand_year)
     rand_url, rand_apod_date = make_url(API_KEY, rand_year, rand_month,
                                         rand_day)
     resp = test_connection(rand_url)
     return resp
 
 
+def generate_batch(API_KEY, count):
+    '''
+    Request count random APODs in a single call using the api's count
+    parameter. Return a list of the entries, empty on any error.
+    '''
+    batch_url = ("https://api.nasa.gov/planetary/apod"
+                 + f"?api_key={API_KEY}&count={count}"
+                 )
+    resp = test_connection(batch_url)
+
+    try:
+        batch = loads(resp.text)
+
+    except (decoder.JSONDecodeError, AttributeError) as error:
+        print(f"generate_batch: {error}")
+        return []
+
+    if not isinstance(batch, list):
+        print(f"generate_batch: {batch}")
+        return []
+
+    cache_entries(batch)
+    return batch
+
+
+def sync_catalog(API_KEY, CATALOG_FILE):
+    '''
+    Fill the catalog with the metadata of every APOD, CATALOG_CHUNK days
+    per request using start_date and end_date. Continue from the newest
+    date already in the catalog so repeat runs only fetch new entries.
+    '''
+    newest = newest_date(CATALOG_FILE)
+
+    if newest is None:
+        start = date(1995, 6, 16)
+
+    else:
+        start = date.fromisoformat(newest) + timedelta(days=1)
+
+    today = date.today()
+
+    while start <= today:
+        end = min(start + timedelta(days=CATALOG_CHUNK - 1), today)
+        sync_url = ("https://api.nasa.gov/planetary/apod"
+                    + f"?api_key={API_KEY}&start_date={start.isoformat()}"
+                    + f"&end_date={end.isoformat()}"
+                    )
+        resp = test_connection(sync_url, max_wait=RATE_MAX_WAIT)
+
+        try:
+            entries = loads(resp.text)
+
+        except (decoder.JSONDecodeError, AttributeError) as error:
+            print(f"sync_catalog: {error}")
+            return False
+
+        # The api answers an error object when today's APOD is not
+        # published yet. Retry without today, else stop and let the next
+        # sync continue from here.
+        if not isinstance(entries, list):
+            if end == today and start < today:
+                today = today - timedelta(days=1)
+                continue
+
+            print(f"sync_catalog: {entries}")
+            return False
+
+        entries = sorted(entries, key=lambda item: item["date"])
+        cache_entries(entries)
+
+        if not append_catalog(CATALOG_FILE, entries):
+            return False
+
+        print(f"sync_catalog: {start} to {end}, {len(entries)} entries")
+        start = end + timedelta(days=1)
+
+    return True
+
+
 def formulate_data(DATA_FILE, QUALITY, API_KEY, FIELD_NAMES, REDOWNLOAD,
                    field_dict, date_time, resp):
     '''
     Check if an image is in the response text. If the filename is in the
     data file run the function generate_data to get a new APOD.
     '''
+    try:
+        resp_dict = loads(resp.text)
+
+    except (decoder.JSONDecodeError, AttributeError) as error:
+        print(f"ERROR: formulate_data(1): {error}")
+        return False
+
+    return formulate_entry(DATA_FILE, QUALITY, FIELD_NAMES, REDOWNLOAD,
+                           field_dict, date_time, resp_dict)
+
+
+def formulate_entry(DATA_FILE, QUALITY, FIELD_NAMES, REDOWNLOAD, field_dict,
+                    date_time, resp_dict, owned=None):
+    '''
+    Fill field_dict from a single APOD entry. Return False if the entry
+    is not an image or is already in the library. Pass a set of owned
+    filenames as owned to check against instead of the library index.
+    '''
     escape_list = ["(", ")", "{", "}", "|" "\\"]
     regex_string = r"image/[0-9]{4}/(.*\.(jpg|jpeg|png))"
 
+    # videos and cached negative entries, nothing to download.
+    if resp_dict.get("media_type", "image") != "image":
+        return False
+
     try:
-        resp_dict = loads(resp.text)
         field_dict["uid"] = date_time
         field_dict["date"] = resp_dict["date"]
         field_dict["title"] = resp_dict["title"]
@@ -119,9 +547,8 @@ def formulate_data(DATA_FILE, QUALITY, API_KEY, FIELD_NAMES, REDOWNLOAD,
             resp_dict["hdurl"],
             re.I).group(1)
 
-    except (decoder.JSONDecodeError, re.error, KeyError, AttributeError) as \
-            error:
-        print(f"ERROR: formulate_data(1): {error}")
+    except (re.error, KeyError, AttributeError, TypeError) as error:
+        print(f"ERROR: formulate_entry: {error}")
         return False
 
     try:
@@ -148,42 +575,244 @@ def formulate_data(DATA_FILE, QUALITY, API_KEY, FIELD_NAMES, REDOWNLOAD,
                         char, ""
                         )
 
-    reader = read_data_rows(DATA_FILE, FIELD_NAMES)
-    for row in reader:
-        if field_dict["filename"] in row["filename"]:
-            if REDOWNLOAD.lower() == "true":
-                return True
+    if owned is None:
+        owned = get_library_index(DATA_FILE, FIELD_NAMES)["filenames"]
 
-            else:
-                return False
+    if field_dict["filename"] in owned:
+        return REDOWNLOAD.lower() == "true"
 
-    else:
-        return True
+    return True
+
+
+def read_part_info(info_path):
+    '''Read the sidecar of a partial download, return a dict or None.'''
+    try:
+        with open(info_path, "r") as info_file:
+            return loads(info_file.read())
+
+    except (FileNotFoundError, PermissionError, OSError,
+            decoder.JSONDecodeError):
+        return None
 
 
-def download_apod(IMAGE_DIR, field_dict):
+def write_part_info(info_path, part_info):
+    '''Write the sidecar of a partial download.'''
+    try:
+        with open(info_path, "w") as info_file:
+            info_file.write(dumps(part_info))
+
+    except (PermissionError, OSError) as error:
+        print(f"write_part_info: {error}")
+
+
+def resume_headers(url, part_path, info_path):
     '''
-    Download an APOD. Call functions to check the header and then a function
-    to append the apod data to the data file.
+    Build the Range / If-Range headers to resume a partial download.
+    Return a tuple of the headers and the bytes already received. Resume
+    only when the sidecar matches the url and has a strong validator.
     '''
-    # Open the response and download the image. Open the data file and
-    resp = test_connection(field_dict["img-url"])
-    resp.raw.decode_content = True
+    part_info = read_part_info(info_path)
+
+    if part_info is None or part_info.get("url") != url:
+        return ({}, 0)
 
     try:
-        with open(str(Path(IMAGE_DIR).joinpath(field_dict["filename"])),
-                  "wb") as image:
-            image.write(resp.content)
+        received = Path(part_path).stat().st_size
 
-    except (PermissionError, OSError) as error:
+    except (FileNotFoundError, OSError):
+        return ({}, 0)
+
+    validator = part_info.get("etag", "")
+
+    if validator == "" or validator.startswith("W/"):
+        validator = part_info.get("last-modified", "")
+
+    if received == 0 or validator == "":
+        return ({}, 0)
+
+    return ({"Range": f"bytes={received}-", "If-Range": validator}, received)
+
+
+def probe_dimensions(parser, chunk):
+    '''
+    Feed a chunk to an incremental image parser. Return the (width,
+    height) once the header has been read, None while it is incomplete
+    and False if the data can not be parsed.
+    '''
+    try:
+        parser.feed(chunk)
+
+    except (OSError, SyntaxError, ValueError):
+        return False
+
+    if parser.image is None:
+        return None
+
+    return parser.image.size
+
+
+def download_apod(IMAGE_DIR, field_dict, MIN_SIZE=None, cancel=None,
+                  claim=None):
+    '''
+    Download an APOD. Stream the image in chunks to a .part file in
+    IMAGE_DIR, then rename it over the final filename so a failed
+    download never leaves a truncated image behind. A sidecar next to
+    the .part file records the url, validators and bytes received so an
+    interrupted download is resumed with a Range request. With MIN_SIZE
+    the image header is parsed as it arrives and the download is dropped
+    as soon as the image is known to be too small.
+
+    For hedged downloads, cancel is a threading.Event that stops the
+    download, and claim is called once the image passed the size check.
+    If claim returns False another download won and this one stops.
+
+    A filename is downloaded by one thread at a time, the prefetch buffer
+    and main never share a .part file.
+    '''
+    with DOWNLOADING_LOCK:
+        if field_dict["filename"] in DOWNLOADING:
+            print(f"download_apod: {field_dict['filename']} is already"
+                  + " being downloaded")
+            return False
+
+        DOWNLOADING.add(field_dict["filename"])
+
+    try:
+        return fetch_apod(IMAGE_DIR, field_dict, MIN_SIZE, cancel, claim)
+
+    finally:
+        with DOWNLOADING_LOCK:
+            DOWNLOADING.discard(field_dict["filename"])
+
+
+def fetch_apod(IMAGE_DIR, field_dict, MIN_SIZE, cancel, claim):
+    '''Stream an APOD to disk for download_apod.'''
+    url = field_dict["img-url"]
+    image_path = Path(IMAGE_DIR).joinpath(field_dict["filename"])
+    part_path = image_path.with_name(image_path.name + ".part")
+    info_path = image_path.with_name(image_path.name + ".part.json")
+
+    headers, received = resume_headers(url, part_path, info_path)
+    resp = test_connection(url, headers)
+
+    if resp is not None and resp.status_code == 416:
+        # Range not satisfiable, the part file is stale. Start over.
+        resp.close()
+        delete_file(part_path)
+        delete_file(info_path)
+        received = 0
+        resp = test_connection(url)
+
+    if resp is None:
+        return False
+
+    part_info = {}
+
+    try:
+        resp.raise_for_status()
+        content_range = resp.headers.get("Content-Range", "")
+
+        # 206 continues the part file, anything else means the server
+        # ignored the range or the validators changed. Download it all.
+        if (resp.status_code == 206
+                and content_range.startswith(f"bytes {received}-")):
+            mode = "ab"
+
+        else:
+            mode = "wb"
+            received = 0
+
+        part_info = {"url": url,
+                     "etag": resp.headers.get("ETag", ""),
+                     "last-modified": resp.headers.get("Last-Modified", ""),
+                     "received": received}
+        write_part_info(info_path, part_info)
+        synced = received
+        parser = None
+        undersized = None
+
+        # only a download starting at byte zero sees the image header.
+        if MIN_SIZE is not None and received == 0:
+            parser = ImageFile.Parser()
+            min_width, min_height = min_dimensions(MIN_SIZE)
+
+        cancelled = False
+
+        with open(part_path, mode) as image:
+            for chunk in resp.iter_content(chunk_size=CHUNK_SIZE):
+                if cancel is not None and cancel.is_set():
+                    cancelled = True
+                    break
+
+                image.write(chunk)
+                received += len(chunk)
+
+                if parser is not None:
+                    dimensions = probe_dimensions(parser, chunk)
+
+                    if dimensions and (dimensions[0] < min_width
+                                       or dimensions[1] < min_height):
+                        undersized = dimensions
+                        break
+
+                    if dimensions is not None or received > PROBE_SIZE:
+                        parser = None
+
+                if claim is not None and parser is None:
+                    if not claim():
+                        cancelled = True
+                        break
+
+                    claim = None
+
+                if received - synced >= PART_SYNC_SIZE:
+                    image.flush()
+                    part_info["received"] = synced = received
+                    write_part_info(info_path, part_info)
+
+        # finished before the header was read, claim it now.
+        if (claim is not None and not cancelled and undersized is None
+                and not claim()):
+            cancelled = True
+
+        if cancelled:
+            delete_file(part_path)
+            delete_file(info_path)
+            return False
+
+        if undersized is not None:
+            print(f"download_apod: {field_dict['filename']} is"
+                  + f" {undersized[0]}x{undersized[1]}, below {MIN_SIZE}")
+            field_dict["img-WxH"] = f"{undersized[0]}x{undersized[1]}"
+            mark_undersized(field_dict)
+            delete_file(part_path)
+            delete_file(info_path)
+            return False
+
+        os.replace(part_path, image_path)
+        delete_file(info_path)
+        return True
+
+    except (requests.exceptions.RequestException, PermissionError,
+            OSError) as error:
         print(f"download_apod: {error}")
 
+        if part_info:
+            part_info["received"] = received
+            write_part_info(info_path, part_info)
+        return False
+
+    finally:
+        resp.close()
+
 
 def set_background(IMAGE_DIR, QUALITY, CUSTOM_CMD, CUSTOM_ENV, field_dict):
     '''
     Set the downloaded APOD as wallpaper. Determine the users
     $XDG_CURRENT_DESKTOP if on linux, if on windows or mac use sys to
-    check platform.
+    check platform. Windows and the linux desktops are given a copy
+    rendered at the monitor's resolution, xfce one per monitor. A custom
+    command and mac are given the image itself.
     '''
     background_path = IMAGE_DIR.joinpath(field_dict["filename"])
     wallpaper_cmd = ""
@@ -195,10 +824,10 @@ def set_background(IMAGE_DIR, QUALITY, CUSTOM_CMD, CUSTOM_ENV, field_dict):
     # check if custom command, apply wallpaper and return if so.
     if CUSTOM_CMD.strip() != "":
         wallpaper_cmd = CUSTOM_CMD
-        wallpaper = wallpaper_cmd.format(str(background_path))
 
     # set windows wallpaper and return
     elif "win32" in sys.platform.lower():
+        background_path = render_wallpapers(background_path)[0][1]
         ctypes.windll.user32.SystemParametersInfoW(
                 0x14,
                 0,
@@ -238,7 +867,7 @@ def set_background(IMAGE_DIR, QUALITY, CUSTOM_CMD, CUSTOM_ENV, field_dict):
         elif "xfce" in check_desktop:
             wallpaper_cmd = ("xfconf-query -c xfce4-desktop -p /backdrop"
                              + "/screen0/monitor0/workspace0/last-image"
-                             + "-s s {}"
+                             + " -s {}"
                              )
         # kde
         elif "kde" in check_desktop:
@@ -250,6 +879,19 @@ def set_background(IMAGE_DIR, QUALITY, CUSTOM_CMD, CUSTOM_ENV, field_dict):
                     + ' image to POSIX file “{}”‘'
                     )
 
+        if wallpaper_cmd != "" and "darwin" not in sys.platform.lower():
+            wallpapers = render_wallpapers(background_path)
+            background_path = shlex.quote(str(wallpapers[0][1]))
+
+            # xfce keeps a wallpaper per monitor, named as xrandr does.
+            if "xfce" in check_desktop and wallpapers[0][0] is not None:
+                wallpaper_cmd = " && ".join(
+                        "xfconf-query -c xfce4-desktop -p /backdrop/screen0"
+                        + f"/monitor{monitor.name}/workspace0/last-image"
+                        + f" -n -t string -s {shlex.quote(str(path))}"
+                        for monitor, path in wallpapers).replace(
+                                "{", "{{").replace("}", "}}")
+
     wallpaper = wallpaper_cmd.format(str(background_path))
 
     try:
@@ -265,27 +907,9 @@ def gen_day(rand_month, rand_year):
     Generate a valid random day of the month. Factor for leap year,
     and days in accompanying month.
     '''
-    # Check if the month is Febuary, if so determine if it is a leap year.
-    # If year divisible by 4, and not divisible by 100, unless also divisible
-    # by 400.
-    if int(rand_month) == 2:
-        if int(rand_year) % 4 == 0 and int(rand_year) % 100 != 0:
-            if int(rand_year) % 400 == 0:
-                rand_day = random.randint(1, 29)
-                return rand_day
-
-        else:
-            rand_day = random.randint(1, 28)
-            return rand_day
-
-    # Determine if the month has 30 days, else the only option left is 31.
-    if rand_month in [4, 6, 9, 11] and rand_month != 1:
-        rand_day = random.randint(1, 30)
-        return rand_day
-
-    else:
-        rand_day = random.randint(1, 31)
-        return rand_day
+    days_in_month = calendar.monthrange(int(rand_year), int(rand_month))[1]
+    rand_day = random.randint(1, days_in_month)
+    return rand_day
 
 
 def gen_month():
@@ -301,32 +925,26 @@ def gen_year():
     Generate a random year between the year of the first APOD(1995),
     and today's date.
     '''
-    date = datetime.now().strftime("%Y%m%d")
-    firstapod = str(19950616)
-    rand_year = str(random.randint(int(firstapod), int(date)))[:4]
+    rand_year = random.randint(FIRST_APOD.year, date.today().year)
     return rand_year
 
 
 def test_valid(rand_day, rand_month, rand_year):
     '''
-    Test the generated date to determine if it is in the three days
-    after the first APOD, they did not have an APOD. If so generate
-    a new day in place and test again.
+    Test the generated date to determine if it is before the first APOD,
+    in the three days after it when there was no APOD, or in the future.
+    If so generate a new date and test again. Return (year, month, day).
     '''
-    misstime = [950617, 950618, 950619]
-    rand_date = (str(rand_year)
-                 + str(rand_month)
-                 + str(rand_day)
-                 )
-    newrand_date = (str(rand_year)
-                    + str(rand_month)
-                    + str(gen_day(rand_month, rand_year))
-                    )
-    # Check if the generated random date is not one of the three days
-    # after the first apod was released. No apods on those days.
-    if rand_date in misstime:
-        rand_date = newrand_date
-        return rand_date
+    while True:
+        rand_date = date(int(rand_year), int(rand_month), int(rand_day))
+
+        if (FIRST_APOD <= rand_date <= date.today()
+                and rand_date not in MISSING_DAYS):
+            return (rand_year, rand_month, rand_day)
+
+        rand_year = gen_year()
+        rand_month = gen_month()
+        rand_day = gen_day(rand_month, rand_year)
 
 
 def make_url(API_KEY, rand_year, rand_month, rand_day):
@@ -349,40 +967,46 @@ def make_url(API_KEY, rand_year, rand_month, rand_day):
     return (rand_url, rand_apod_date)
 
 
-def verify_dimensions(IMAGE_DIR, MIN_SIZE, field_dict):
-    '''
-    Verify the APOD images dimensions. If the images are less than
-    the value of MIN_SIZE return False.
-    '''
+def min_dimensions(MIN_SIZE):
+    '''Return MIN_SIZE "WIDTHxHEIGHT" as a tuple of ints.'''
     image_min_size = MIN_SIZE.split("x")
 
     try:
-        min_width, min_height = image_min_size[0], image_min_size[1]
+        return (int(image_min_size[0]), int(image_min_size[1]))
 
-    except IndexError:
-        min_width, min_height = (0, 0)
-        pass
+    except (IndexError, ValueError):
+        return (0, 0)
 
-    try:
-        wallpaper = Image.open(IMAGE_DIR.joinpath(field_dict["filename"]))
-        apod_width = wallpaper.width
-        apod_height = wallpaper.height
-        apod_size = int(
-                IMAGE_DIR.joinpath(field_dict["filename"]).stat().st_size
-                )
 
-        if float(apod_size) < 102400:
-            _size = round((apod_size / 1024), 2)
-            apod_size = str(_size) + " Kb"
+def mark_undersized(field_dict):
+    '''Move an APOD below MIN_SIZE from the orig to the tmp category.'''
+    if "orig" in field_dict["category"]:
+        field_dict["category"].remove("orig")
+
+    if "tmp" not in field_dict["category"]:
+        field_dict["category"].append("tmp")
 
-        else:
-            _size = round(((apod_size / 1024) / 1024), 2)
-            apod_size = str(_size) + " Mb" 
 
-        apod_WxH = "{}x{}".format(str(wallpaper.width), str(wallpaper.height))
+def verify_dimensions(IMAGE_DIR, MIN_SIZE, field_dict, pipeline=None):
+    '''
+    Verify the APOD images dimensions. If the images are less than
+    the value of MIN_SIZE return False. Only the image header is read.
+    '''
+    min_width, min_height = min_dimensions(MIN_SIZE)
+
+    if pipeline is None:
+        with ImagePipeline(
+                Path(IMAGE_DIR).joinpath(field_dict["filename"])) as pipeline:
+            return verify_dimensions(IMAGE_DIR, MIN_SIZE, field_dict,
+                                     pipeline)
+
+    try:
+        apod_width, apod_height = pipeline.dimensions()
+        apod_size = pipeline.file_size()
+
+        apod_WxH = "{}x{}".format(str(apod_width), str(apod_height))
         field_dict["img-WxH"] = apod_WxH
         field_dict["img-size"] = apod_size
-        wallpaper.close()
 
     except (FileNotFoundError, PermissionError, OSError) as error:
         print(f"verify_dimensions: {error}")
@@ -390,73 +1014,82 @@ def verify_dimensions(IMAGE_DIR, MIN_SIZE, field_dict):
 
 
     if int(apod_width) < int(min_width) or int(apod_height) < int(min_height):
-        if "orig" in field_dict["category"]:
-            field_dict["category"].remove("orig")
-
-        if "tmp" not in field_dict["category"]:
-            field_dict["category"].append("tmp")
+        mark_undersized(field_dict)
         return False
 
 
-def create_thumbnail(IMAGE_DIR, TIMG_DIR, DATA_FILE, FIELD_NAMES, field_dict):
+def create_thumbnail(IMAGE_DIR, TIMG_DIR, DATA_FILE, FIELD_NAMES, field_dict,
+                     pipeline=None):
     '''Create a thumbnail of an APOD.'''
+    if pipeline is None:
+        with ImagePipeline(
+                Path(IMAGE_DIR).joinpath(field_dict["filename"])) as pipeline:
+            return create_thumbnail(IMAGE_DIR, TIMG_DIR, DATA_FILE,
+                                    FIELD_NAMES, field_dict, pipeline)
+
     try:
-        wallpaper = Image.open(
-                Path(IMAGE_DIR).joinpath(field_dict["filename"])
-                )
-        wallpaper.thumbnail((310, 310))
-        wallpaper.convert("RGB").save(
-            Path(TIMG_DIR).joinpath(field_dict["filename"]),
-            quality=95,
-            optimize=True,
-            subsampling=0,
-            compress_level=0,
-            icc_profile=wallpaper.info.get('icc_profile')
-            )
-        wallpaper.close()
+        pipeline.thumbnail(Path(TIMG_DIR).joinpath(field_dict["filename"]))
 
         if "timg" not in field_dict["category"]:
             field_dict["category"].append("timg")
 
-    except (FileNotFoundError, PermissionError, OSError) as error:
+    except (FileNotFoundError, PermissionError, OSError, ValueError) as error:
         print(f"create_thumbnail: {error}")
         return
 
 
+def regenerate_images(DATA_FILE, FIELD_NAMES, IMAGE_DIR, TIMG_DIR, MIN_SIZE,
+                     CROP_RATIO, WORKERS, thumbnails=True, crops=False):
+    '''
+    Rebuild the thumbnails of the entries in the timg category and the
+    crops of the entries in the crop category whose image is still saved,
+    across a pool of worker processes. Return the amount of images done.
+    '''
+    jobs = []
+
+    for record in read_records(DATA_FILE, FIELD_NAMES):
+        thumbnail = thumbnails and Category.TIMG in record.category
+        crop = crops and Category.CROP in record.category
+
+        if not (thumbnail or crop):
+            continue
+
+        if not Path(IMAGE_DIR).joinpath(record.filename).is_file():
+            continue
+
+        jobs.append(image_job(IMAGE_DIR, TIMG_DIR, record.filename, MIN_SIZE,
+                              CROP_RATIO if crop else None, thumbnail))
+
+    written = 0
+
+    for result in process_images(jobs, WORKERS):
+        if result["error"] is not None:
+            print(f"regenerate_images: {result['error']}")
+            continue
+
+        written += 1
+
+    return written
+
+
 def crop_image(IMAGE_DIR, DATA_FILE, QUALITY, MIN_SIZE, CROP_RATIO,
-               FIELD_NAMES, field_dict):
+               FIELD_NAMES, field_dict, pipeline=None):
     '''
     Crop the image to a specific aspect ratio.
     '''
-    crop_ratio = CROP_RATIO.split(":")
-    crop_ratio = int(crop_ratio[1]) / int(crop_ratio[0])
+    if pipeline is None:
+        with ImagePipeline(
+                Path(IMAGE_DIR).joinpath(field_dict["filename"])) as pipeline:
+            return crop_image(IMAGE_DIR, DATA_FILE, QUALITY, MIN_SIZE,
+                              CROP_RATIO, FIELD_NAMES, field_dict, pipeline)
 
     try:
-        wallpaper = Image.open(IMAGE_DIR.joinpath(field_dict["filename"]))
-        width = wallpaper.width
-        height = wallpaper.height
+        width, height = pipeline.dimensions()
 
     except (FileNotFoundError, PermissionError, OSError) as error:
         print(f"crop_image(1): {error}")
         return
 
-    left, top, right, bottom = (0, 0, 0, 0)
-    crop_height = 0
-
-    if int(width) >= int(height):
-        crop_height = int(height * crop_ratio)
-        left = 0
-        right = width
-        bottom = int((height - crop_height) / 2)
-        top = bottom + crop_height
-
-    if int(height) > int(width):
-        crop_height = int(width * crop_ratio)
-        bottom = int((height - crop_height) / 2)
-        top = bottom + crop_height
-        left = left
-        right = left + width
-
     crop_filename = field_dict["filename"].split(".")
     crop_filename = f"{crop_filename[0]}-crop.{crop_filename[1]}"
 
@@ -464,20 +1097,10 @@ def crop_image(IMAGE_DIR, DATA_FILE, QUALITY, MIN_SIZE, CROP_RATIO,
         field_dict["category"].append("crop")
 
     try:
-        with Image.open(IMAGE_DIR.joinpath(field_dict["filename"])) as \
-                wallpaper:
-            crop = wallpaper.crop((left, bottom, right, top))
-            crop.convert("RGB").save(
-                    IMAGE_DIR.joinpath(crop_filename),
-                    quality=95,
-                    optimize=True,
-                    subsampling=0,
-                    compress_level=0,
-                    icc_profile=wallpaper.info.get(
-                    'icc_profile')
-                    )
+        pipeline.crop(Path(IMAGE_DIR).joinpath(crop_filename),
+                      crop_box(width, height, CROP_RATIO))
 
-    except (FileNotFoundError, PermissionError, OSError) as error:
+    except (FileNotFoundError, PermissionError, OSError, ValueError) as error:
         print(f"crop_image(2): {error}")
         return
 
@@ -488,14 +1111,11 @@ def check_data_header(DATA_FILE, FIELD_NAMES):
     header
     '''
     try:
-        with open(DATA_FILE, "r") as data_file:
-            reader = data_file.readline()
-            field_names = ",".join(FIELD_NAMES)
-
-            if field_names not in reader:
-                return write_data_header(DATA_FILE, FIELD_NAMES)
+        if not get_storage(DATA_FILE, FIELD_NAMES).has_header():
+            return write_data_header(DATA_FILE, FIELD_NAMES)
 
-    except (csv.Error, FileNotFoundError, PermissionError, OSError) as error:
+    except (csv.Error, sqlite3.Error, FileNotFoundError, PermissionError,
+            OSError) as error:
         print(f"check_data_header: {error}")
         return write_data_header(DATA_FILE, FIELD_NAMES)
 
@@ -513,39 +1133,37 @@ def check_data_exists(DATA_FILE):
 def write_data_header(DATA_FILE, FIELD_NAMES):
     '''Write data file header with field names.'''
     try:
-        with open(DATA_FILE, "w", newline="") as data_file:
-            writer = csv.DictWriter(data_file,
-                                    fieldnames=FIELD_NAMES
-                                    )
-            writer.writeheader()
+        get_storage(DATA_FILE, FIELD_NAMES).write_header()
 
-    except (csv.Error, PermissionError, OSError, UnicodeEncodeError) as error:
+    except (csv.Error, sqlite3.Error, PermissionError, OSError,
+            UnicodeEncodeError) as error:
         print(f"write_data_header: {error}")
         return
 
 
 def append_data(DATA_FILE, FIELD_NAMES, field_dict):
     '''Append data to the data file.'''
-    try:
-        with open(DATA_FILE, "a", newline="") as data_file:
-            writer = csv.DictWriter(data_file,
-                                    fieldnames=FIELD_NAMES
-                                    )
-            writer.writerow({
-                "date": field_dict["date"],
-                "title": field_dict["title"],
-                "explanation": field_dict["explanation"],
-                "html": field_dict["html"],
-                "img-url": field_dict["img-url"],
-                "filename": field_dict["filename"],
-                "img-WxH": field_dict["img-WxH"],
-                "img-size": field_dict["img-size"],
-                "copyright": field_dict["copyright"],
-                "uid": field_dict["uid"],
-                "category": field_dict["category"]}
-                            )
+    append_data_rows(DATA_FILE, FIELD_NAMES, [field_dict])
 
-    except (csv.Error, PermissionError, OSError) as error:
+
+def append_data_rows(DATA_FILE, FIELD_NAMES, field_dicts):
+    '''Append a list of field dicts to the data file in one write.'''
+    try:
+        get_storage(DATA_FILE, FIELD_NAMES).append_rows([{
+            "date": field_dict["date"],
+            "title": field_dict["title"],
+            "explanation": field_dict["explanation"],
+            "html": field_dict["html"],
+            "img-url": field_dict["img-url"],
+            "filename": field_dict["filename"],
+            "img-WxH": field_dict["img-WxH"],
+            "img-size": field_dict["img-size"],
+            "copyright": field_dict["copyright"],
+            "uid": field_dict["uid"],
+            "category": field_dict["category"]}
+            for field_dict in field_dicts])
+
+    except (csv.Error, sqlite3.Error, PermissionError, OSError) as error:
         print(f"append_data(1): {error}")
         return
 
@@ -553,41 +1171,79 @@ def append_data(DATA_FILE, FIELD_NAMES, field_dict):
         print(f"append_data(2): {error}")
         pass
 
+    if DATE_INDEX is not None:
+        for field_dict in field_dicts:
+            DATE_INDEX["index"].mark_owned(field_dict["date"])
+
+    # replace the sets rather than add to them, other threads may be
+    # reading them.
+    if LIBRARY_INDEX is not None and LIBRARY_INDEX["path"] == str(DATA_FILE):
+        LIBRARY_INDEX["filenames"] = LIBRARY_INDEX["filenames"].union(
+                field_dict["filename"] for field_dict in field_dicts)
+        LIBRARY_INDEX["dates"] = LIBRARY_INDEX["dates"].union(
+                field_dict["date"] for field_dict in field_dicts)
+        LIBRARY_INDEX["stamp"] = get_storage(DATA_FILE, FIELD_NAMES).stamp()
+
 
 def write_data_rows(DATA_FILE, FIELD_NAMES, data_rows):
-    '''Write a new data file from a list.'''
+    '''Write a new data file from a list of rows or records.'''
+    data_rows = [ApodRecord.from_row(row) for row in data_rows]
+
     try:
-        with open(DATA_FILE, "w", newline="") as data_file:
-            writer = csv.DictWriter(data_file,
-                                    fieldnames=FIELD_NAMES
-                                    )
-            writer.writeheader()
-            writer.writerows(data_rows)
+        get_storage(DATA_FILE, FIELD_NAMES).write_rows(data_rows)
 
-    except (csv.Error, PermissionError, OSError) as error:
+    except (csv.Error, sqlite3.Error, PermissionError, OSError) as error:
         print(f"write_data_rows: {error}")
         return
 
+    if LIBRARY_INDEX is not None and LIBRARY_INDEX["path"] == str(DATA_FILE):
+        LIBRARY_INDEX["filenames"] = {row.filename for row in data_rows}
+        LIBRARY_INDEX["dates"] = {row.date_text() for row in data_rows}
+        LIBRARY_INDEX["stamp"] = get_storage(DATA_FILE, FIELD_NAMES).stamp()
 
-def read_data_rows(DATA_FILE, FIELD_NAMES):
-    '''Read data file, return a list of dictionaries sorted by UID'''
-    data_rows = []
+
+def get_library_index(DATA_FILE, FIELD_NAMES):
+    '''
+    Return a dict with the sets of owned filenames and dates. Loaded once
+    per process, kept current by append_data and write_data_rows, and
+    reloaded only if another process changed the data file.
+    '''
+    global LIBRARY_INDEX
+
+    storage = get_storage(DATA_FILE, FIELD_NAMES)
+    stamp = storage.stamp()
+
+    if (LIBRARY_INDEX is not None
+            and LIBRARY_INDEX["path"] == str(DATA_FILE)
+            and LIBRARY_INDEX["stamp"] == stamp):
+        return LIBRARY_INDEX
 
     try:
-        with open(DATA_FILE, "r", newline="") as data_file:
-            reader = csv.DictReader(data_file,
-                                    FIELD_NAMES
-                                    )
+        filenames, dates = storage.owned()
 
-            [data_rows.append(row) for row in reader]
-            data_rows = [data_rows[0]] + sorted(data_rows[1:],
-                                                key=lambda
-                                                item: item["uid"],
-                                                reverse=False
-                                                )
-        return data_rows
+    except (csv.Error, sqlite3.Error, FileNotFoundError, PermissionError,
+            OSError) as error:
+        print(f"get_library_index: {error}")
+        filenames, dates = set(), set()
 
-    except (csv.Error, FileNotFoundError, PermissionError, OSError) as error:
+    LIBRARY_INDEX = {"path": str(DATA_FILE),
+                     "stamp": stamp,
+                     "filenames": filenames,
+                     "dates": dates}
+    return LIBRARY_INDEX
+
+
+def read_data_rows(DATA_FILE, FIELD_NAMES):
+    '''
+    Read data file, return a list of dictionaries sorted by UID. The first
+    item is the header, field names keyed by themselves.
+    '''
+    try:
+        data_rows = get_storage(DATA_FILE, FIELD_NAMES).read_rows()
+        return [{name: name for name in FIELD_NAMES}] + data_rows
+
+    except (csv.Error, sqlite3.Error, FileNotFoundError, PermissionError,
+            OSError) as error:
         print(f"read_data_rows(1): {error}")
         return
 
@@ -596,59 +1252,130 @@ def read_data_rows(DATA_FILE, FIELD_NAMES):
         pass
 
 
-def sort_categories(IMAGE_DIR, TIMG_DIR, data_rows, data_category,
-                    data_save):
-    '''Sort list of dictionaries containing apod data.'''
-    new_data_rows = []
-    category_rows = []
+def read_records(DATA_FILE, FIELD_NAMES):
+    '''Return the data file as a list of ApodRecords sorted by UID.'''
+    try:
+        return get_storage(DATA_FILE, FIELD_NAMES).read_records()
 
-    [category_rows.append(row) for row in data_rows if data_category in
-     row["category"]]
+    except (csv.Error, sqlite3.Error, FileNotFoundError, PermissionError,
+            OSError) as error:
+        print(f"read_records: {error}")
+        return []
 
-    for row in data_rows:
-        if row in category_rows[:len(category_rows) - int(data_save)]:
-            try:
-                # convert the category string back into a list
-                category_list = list(
-                        row["category"].strip("][").replace("'", ""
-                                                            ).split(", "))
 
-            except AttributeError:
-                category_list = row["category"]
+def read_latest_record(DATA_FILE, FIELD_NAMES):
+    '''Return the ApodRecord with the highest UID, None if empty.'''
+    try:
+        return get_storage(DATA_FILE, FIELD_NAMES).latest_record()
 
-            category_list.remove(data_category)
+    except (csv.Error, sqlite3.Error, FileNotFoundError, PermissionError,
+            OSError) as error:
+        print(f"read_latest_record: {error}")
+        return
 
-            if len(category_list) != 0:
-                row["category"] = category_list
-                new_data_rows.append(row)
 
-                if data_category == "timg":
-                    delete_file(TIMG_DIR.joinpath(row["filename"]))
+def read_latest_row(DATA_FILE, FIELD_NAMES):
+    '''Return the data file row with the highest UID, None if empty.'''
+    try:
+        return get_storage(DATA_FILE, FIELD_NAMES).latest_row()
 
-                elif data_category == "crop":
-                    _crop_filename = row["filename"].split(".")
-                    crop_filename = (
-                            f"{_crop_filename[0]}-crop.{_crop_filename[1]}"
-                            )
-                    delete_file(Path(IMAGE_DIR).joinpath(crop_filename))
+    except (csv.Error, sqlite3.Error, FileNotFoundError, PermissionError,
+            OSError) as error:
+        print(f"read_latest_row: {error}")
+        return
 
-                #elif data_category == "tmp":
-                #    if "orig" in row["category"]:
-                #        row["category"].remove("orig")
-                #    delete_file(Path(IMAGE_DIR).joinpath(row["filename"]))
 
-                else:
-                    if data_category == "orig" and "tmp" in row["category"]:
-                        row["category"].remove("tmp")
+def export_data(DATA_FILE, FIELD_NAMES, EXPORT_FILE):
+    '''Copy every row of the data file into a CSV file.'''
+    data_rows = (read_data_rows(DATA_FILE, FIELD_NAMES) or [])[1:]
 
-                    delete_file(Path(IMAGE_DIR).joinpath(row["filename"]))
+    try:
+        CSVStorage(EXPORT_FILE, FIELD_NAMES).write_rows(data_rows)
 
-            else:
-                new_data_rows.append(row)
+    except (csv.Error, PermissionError, OSError) as error:
+        print(f"export_data: {error}")
 
-        else:
-            new_data_rows.append(row)
-    return new_data_rows
+
+def import_data(DATA_FILE, FIELD_NAMES, IMPORT_FILE):
+    '''Append the rows of a CSV file not already in the data file.'''
+    try:
+        data_rows = CSVStorage(IMPORT_FILE, FIELD_NAMES).read_rows()
+
+    except (csv.Error, FileNotFoundError, PermissionError, OSError) as error:
+        print(f"import_data: {error}")
+        return
+
+    storage = get_storage(DATA_FILE, FIELD_NAMES)
+
+    with storage.lock:
+        owned = get_library_index(DATA_FILE, FIELD_NAMES)["filenames"]
+        data_rows = [row for row in data_rows if row["filename"] not in owned]
+        latest = read_latest_row(DATA_FILE, FIELD_NAMES)
+
+        # the data file is kept in uid order, older rows mean a rewrite.
+        if latest is not None and any(str(row["uid"]) < str(latest["uid"])
+                                      for row in data_rows):
+            write_data_rows(DATA_FILE, FIELD_NAMES,
+                            read_records(DATA_FILE, FIELD_NAMES)
+                            + data_rows)
+            return
+
+        try:
+            storage.append_rows(data_rows)
+
+        except (csv.Error, sqlite3.Error, PermissionError, OSError) as error:
+            print(f"import_data: {error}")
+            return
+
+    if LIBRARY_INDEX is not None and LIBRARY_INDEX["path"] == str(DATA_FILE):
+        LIBRARY_INDEX["stamp"] = None
+
+
+def plan_retention(records, category_dict):
+    '''
+    Work out the evictions of every category in one pass. category_dict
+    maps each category to the amount to keep and is applied in order,
+    oldest records are evicted first. A record keeps its last category so
+    its entry stays in the data file. Return the records with their new
+    categories and a list of (record, category) evictions.
+    '''
+    records = sorted(records, key=lambda item: item.uid)
+    categories = [record.category for record in records]
+    evictions = []
+
+    for data_category, data_save in category_dict.items():
+        flag = Category[data_category.upper()]
+        members = [index for index, flags in enumerate(categories)
+                   if flag in flags]
+
+        for index in members[:max(0, len(members) - int(data_save))]:
+            if categories[index] == flag:
+                continue
+
+            categories[index] &= ~flag
+
+            if flag == Category.ORIG:
+                categories[index] &= ~Category.TMP
+
+            evictions.append((records[index], data_category))
+
+    new_records = [record.with_category(flags) for record, flags
+                   in zip(records, categories)]
+    return new_records, evictions
+
+
+def evict_file(IMAGE_DIR, TIMG_DIR, record, data_category):
+    '''Delete the file a record holds for a category.'''
+    if data_category == "timg":
+        delete_file(Path(TIMG_DIR).joinpath(record.filename))
+
+    elif data_category == "crop":
+        _crop_filename = record.filename.split(".")
+        crop_filename = f"{_crop_filename[0]}-crop.{_crop_filename[1]}"
+        delete_file(Path(IMAGE_DIR).joinpath(crop_filename))
+
+    else:
+        delete_file(Path(IMAGE_DIR).joinpath(record.filename))
 
 
 def dir_cleanup(DATA_FILE, TIMG_SAVE, IMAGE_DIR, TIMG_DIR, ORIG_SAVE,
@@ -659,14 +1386,18 @@ def dir_cleanup(DATA_FILE, TIMG_SAVE, IMAGE_DIR, TIMG_DIR, ORIG_SAVE,
     category_dict = {"timg": TIMG_SAVE, "crop": CROP_SAVE, "orig": ORIG_SAVE,
                      "tmp": TMP_SAVE}
 
-    data_rows = read_data_rows(DATA_FILE, FIELD_NAMES)[1:]
+    # hold the data file lock so no other process appends in between.
+    with get_storage(DATA_FILE, FIELD_NAMES).lock:
+        records, evictions = plan_retention(
+                read_records(DATA_FILE, FIELD_NAMES), category_dict)
+
+        if len(evictions) == 0:
+            return
 
-    for key, value in category_dict.items():
-        for item in range(len(category_dict.items())):
-            data_rows = sort_categories(IMAGE_DIR, TIMG_DIR, data_rows, key,
-                                        value)
+        for record, data_category in evictions:
+            evict_file(IMAGE_DIR, TIMG_DIR, record, data_category)
 
-    write_data_rows(DATA_FILE, FIELD_NAMES, data_rows)
+        write_data_rows(DATA_FILE, FIELD_NAMES, records)
 
 
 def delete_file(file):
@@ -702,27 +1433,404 @@ def return_formulate_data(DATA_FILE, QUALITY, API_KEY, FIELD_NAMES, REDOWNLOAD,
                           field_dict, date_time, resp)
 
 
+def get_date_index(DATA_FILE, FIELD_NAMES):
+    '''
+    Return the date index and the catalog entries by date. Built once
+    from the catalog, the metadata cache and the data file, then kept
+    current by append_data. Rebuilt when the catalog file changes.
+    '''
+    global DATE_INDEX
+
+    CATALOG_FILE = catalog_path(DATA_FILE)
+
+    try:
+        stamp = (str(CATALOG_FILE), CATALOG_FILE.stat().st_mtime_ns)
+
+    except (FileNotFoundError, OSError):
+        stamp = (str(CATALOG_FILE), 0)
+
+    if DATE_INDEX is not None and DATE_INDEX["stamp"] == stamp:
+        return DATE_INDEX
+
+    index = DateIndex()
+    catalog = {entry["date"]: entry for entry in read_catalog(CATALOG_FILE)}
+
+    for apod_date, entry in catalog.items():
+        if entry["media_type"] == "image":
+            index.mark_image(apod_date)
+
+        else:
+            index.mark_other(apod_date)
+
+    if METADATA_CACHE is not None:
+        for key, entry in list(METADATA_CACHE.entries.items()):
+            # today and recent errors may still change.
+            if not METADATA_CACHE.is_final(key):
+                continue
+
+            elif entry["media_type"] == "image":
+                index.mark_image(key)
+
+            else:
+                index.mark_other(key)
+
+    for apod_date in get_library_index(DATA_FILE, FIELD_NAMES)["dates"]:
+        index.mark_owned(apod_date)
+
+    index.build_pool()
+    DATE_INDEX = {"stamp": stamp, "index": index, "catalog": catalog}
+    return DATE_INDEX
+
+
+def busy_filenames():
+    '''
+    Return the filenames being downloaded or waiting in the prefetch
+    buffer, random picks leave them out.
+    '''
+    with DOWNLOADING_LOCK:
+        busy = set(DOWNLOADING)
+
+    if PREFETCH_QUEUE is not None:
+        busy.update(PREFETCH_QUEUE.filenames())
+
+    return busy
+
+
+def log_rejected(DATA_FILE, FIELD_NAMES, field_dict, date_time):
+    '''
+    Append an APOD that download_apod rejected from its header as a tmp
+    entry without files, so the same image is not downloaded again. It
+    takes the run's date_time as uid so the run's own entry, appended
+    last, stays the latest. Return True if it was rejected.
+    '''
+    if "tmp" not in field_dict["category"]:
+        return False
+
+    field_dict["uid"] = date_time
+    append_data(DATA_FILE, FIELD_NAMES, field_dict)
+    return True
+
+
+def restore_date(field_dict):
+    '''
+    Put the date of a random APOD whose download failed back in the date
+    index so it can be drawn again. Images rejected for their size stay
+    out, they are marked tmp by download_apod.
+    '''
+    if DATE_INDEX is None or "tmp" in field_dict["category"]:
+        return
+
+    DATE_INDEX["index"].restore(field_dict.get("date", ""))
+
+
+def random_entries(DATA_FILE, FIELD_NAMES, API_KEY):
+    '''
+    Yield random api entries for unowned image dates. Draw dates from
+    the date index when a catalog has been synced, otherwise request
+    batches of random entries and skip owned and non-image dates. Batch
+    entries are taken one at a time from RANDOM_BUFFER, what a caller
+    does not draw is kept for the next call.
+    '''
+    date_index = get_date_index(DATA_FILE, FIELD_NAMES)
+    index = date_index["index"]
+    catalog = date_index["catalog"]
+
+    if len(catalog) != 0:
+        apod_date = index.draw()
+
+        while apod_date is not None:
+            yield catalog[apod_date.isoformat()]
+            apod_date = index.draw()
+        return
+
+    attempt = 0
+
+    while True:
+        with RANDOM_BUFFER_LOCK:
+            resp_dict = RANDOM_BUFFER.pop() if RANDOM_BUFFER else None
+
+        if resp_dict is None:
+            if attempt == BATCH_ATTEMPTS:
+                return
+
+            attempt += 1
+            batch = generate_batch(API_KEY, RANDOM_BATCH)
+
+            with RANDOM_BUFFER_LOCK:
+                RANDOM_BUFFER.extend(batch)
+            continue
+
+        if resp_dict.get("media_type") != "image":
+            index.mark_other(resp_dict.get("date", ""))
+
+        elif index.is_candidate(resp_dict.get("date", "")):
+            yield resp_dict
+
+
 def formulate_data_loop(DATA_FILE, QUALITY, API_KEY, FIELD_NAMES, REDOWNLOAD,
-                        field_dict, date_time):
-    for attempt in range(10):
-        data = return_formulate_data(DATA_FILE, QUALITY, API_KEY,
-                                     FIELD_NAMES, REDOWNLOAD, field_dict,
-                                     date_time, generate_data(API_KEY))
+                        field_dict, date_time, excluded=()):
+    '''
+    Pick a random APOD from random_entries that is not in the library,
+    or whose filename is not in excluded.
+    '''
+    owned = get_library_index(DATA_FILE, FIELD_NAMES)["filenames"]
+    owned = owned.union(excluded)
+    skipped = []
+
+    try:
+        for resp_dict in random_entries(DATA_FILE, FIELD_NAMES, API_KEY):
+            field_dict.update(reset_field_dict(field_dict))
+            data = formulate_entry(DATA_FILE, QUALITY, FIELD_NAMES,
+                                   REDOWNLOAD, field_dict, date_time,
+                                   resp_dict, owned)
 
-        if data:
-            return data
+            if data:
+                return data
 
-    else:
+            if field_dict["filename"] in excluded:
+                skipped.append(dict(field_dict, category=[]))
+
+        else:
+            return False
+
+    finally:
+        # excluded only for this run, they can be drawn again later.
+        for skipped_dict in skipped:
+            restore_date(skipped_dict)
+
+
+def init_hedge(HEDGE_COUNT):
+    '''Set how many random candidates hedged_random races, 0 to turn off.'''
+    global HEDGE
+
+    HEDGE = max(0, int(HEDGE_COUNT))
+
+
+def random_candidates(DATA_FILE, QUALITY, API_KEY, FIELD_NAMES, REDOWNLOAD,
+                      field_dict, date_time, count, excluded=()):
+    '''
+    Return up to count filled field dicts of random images that are not
+    in the library or in excluded.
+    '''
+    owned = get_library_index(DATA_FILE, FIELD_NAMES)["filenames"]
+    owned = owned.union(excluded)
+    candidates = []
+    skipped = []
+
+    for resp_dict in random_entries(DATA_FILE, FIELD_NAMES, API_KEY):
+        candidate = reset_field_dict(field_dict)
+
+        if formulate_entry(DATA_FILE, QUALITY, FIELD_NAMES, REDOWNLOAD,
+                           candidate, date_time, resp_dict, owned):
+            owned.add(candidate["filename"])
+            candidates.append(candidate)
+
+        elif candidate["filename"] in excluded:
+            skipped.append(dict(candidate, category=[]))
+
+        if len(candidates) == count:
+            break
+
+    # excluded only for this run, they can be drawn again later.
+    for skipped_dict in skipped:
+        restore_date(skipped_dict)
+
+    return candidates
+
+
+def hedged_random(DATA_FILE, QUALITY, API_KEY, FIELD_NAMES, REDOWNLOAD,
+                  IMAGE_DIR, MIN_SIZE, field_dict, date_time, excluded=()):
+    '''
+    Download HEDGE random candidates at once. The first one whose header
+    passes MIN_SIZE wins and the others are cancelled. Fill field_dict
+    with the winner and return True once its download finished.
+    '''
+    candidates = random_candidates(DATA_FILE, QUALITY, API_KEY, FIELD_NAMES,
+                                   REDOWNLOAD, field_dict, date_time, HEDGE,
+                                   excluded)
+
+    if len(candidates) == 0:
+        return False
+
+    cancels = [threading.Event() for candidate in candidates]
+    lock = threading.Lock()
+    winner = []
+
+    def claim(index):
+        with lock:
+            if len(winner) != 0:
+                return False
+
+            winner.append(index)
+
+            for num, cancel in enumerate(cancels):
+                if num != index:
+                    cancel.set()
+            return True
+
+    with ThreadPoolExecutor(max_workers=len(candidates)) as executor:
+        futures = [executor.submit(download_apod, IMAGE_DIR, candidate,
+                                   MIN_SIZE, cancels[num], partial(claim, num))
+                   for num, candidate in enumerate(candidates)]
+
+    won = [num for num in winner if futures[num].result()]
+
+    # the cancelled and failed candidates can be drawn again.
+    for num, candidate in enumerate(candidates):
+        if num not in won and not log_rejected(DATA_FILE, FIELD_NAMES,
+                                               candidate, date_time):
+            restore_date(candidate)
+
+    if len(won) != 0:
+        field_dict.update(candidates[won[0]])
+        return True
+
+    return False
+
+
+def init_prefetch(PREFETCH, DATA_FILE, FIELD_NAMES, IMAGE_DIR, TIMG_DIR,
+                  QUALITY, API_KEY, REDOWNLOAD, MIN_SIZE, CROP_RATIO,
+                  field_dict):
+    '''
+    Start the buffer of PREFETCH prepared random APODs and begin filling
+    it in the background. A PREFETCH of 0 turns it off.
+    '''
+    global PREFETCH_QUEUE
+
+    if int(PREFETCH) <= 0:
+        PREFETCH_QUEUE = None
+        return None
+
+    check_data_exists(DATA_FILE)
+    check_folders_exist(IMAGE_DIR, TIMG_DIR)
+    check_data_header(DATA_FILE, FIELD_NAMES)
+
+    def prepare(excluded):
+        return prepare_random(DATA_FILE, FIELD_NAMES, IMAGE_DIR, TIMG_DIR,
+                              QUALITY, API_KEY, REDOWNLOAD, MIN_SIZE,
+                              CROP_RATIO, field_dict, excluded)
+
+    def discard(item):
+        discard_prefetched(DATA_FILE, FIELD_NAMES, item)
+
+    PREFETCH_QUEUE = PrefetchQueue(prefetch_path(DATA_FILE), PREFETCH,
+                                   prepare, discard)
+    PREFETCH_QUEUE.refill()
+    return PREFETCH_QUEUE
+
+
+def prepare_random(DATA_FILE, FIELD_NAMES, IMAGE_DIR, TIMG_DIR, QUALITY,
+                   API_KEY, REDOWNLOAD, MIN_SIZE, CROP_RATIO, field_dict,
+                   excluded):
+    '''
+    Pick, download, verify, thumbnail and crop a random APOD without
+    logging it. Return its field dict, or None if none could be prepared.
+    '''
+    excluded = set(excluded)
+    field_dict = reset_field_dict(field_dict)
+
+    for attempt in range(BATCH_ATTEMPTS):
+        with DOWNLOADING_LOCK:
+            excluded.update(DOWNLOADING)
+
+        if not formulate_data_loop(DATA_FILE, QUALITY, API_KEY, FIELD_NAMES,
+                                   REDOWNLOAD, field_dict, "", excluded):
+            return None
+
+        excluded.add(field_dict["filename"])
+
+        if not download_apod(IMAGE_DIR, field_dict, MIN_SIZE):
+            # main logs it, the refill must not append the latest entry.
+            if "tmp" in field_dict["category"]:
+                if PREFETCH_QUEUE is not None:
+                    PREFETCH_QUEUE.reject(dict(field_dict))
+
+            else:
+                restore_date(field_dict)
+            continue
+
+        with ImagePipeline(
+                Path(IMAGE_DIR).joinpath(field_dict["filename"])) as pipeline:
+            if verify_dimensions(IMAGE_DIR, MIN_SIZE, field_dict,
+                                 pipeline) is False:
+                pipeline.close()
+                delete_file(Path(IMAGE_DIR).joinpath(field_dict["filename"]))
+                continue
+
+            create_thumbnail(IMAGE_DIR, TIMG_DIR, DATA_FILE, FIELD_NAMES,
+                             field_dict, pipeline)
+            crop_image(IMAGE_DIR, DATA_FILE, QUALITY, MIN_SIZE, CROP_RATIO,
+                       FIELD_NAMES, field_dict, pipeline)
+
+        field_dict["image-path"] = str(
+                Path(IMAGE_DIR).joinpath(field_dict["filename"]))
+        field_dict["timg-path"] = str(
+                Path(TIMG_DIR).joinpath(field_dict["filename"]))
+        field_dict["crop-path"] = str(
+                crop_path(IMAGE_DIR, field_dict["filename"]))
+        return field_dict
+
+    return None
+
+
+def discard_prefetched(DATA_FILE, FIELD_NAMES, item):
+    '''
+    Delete the files of a prefetched APOD that is dropped from the buffer.
+    An image already in the library shares its paths, the files the data
+    file still holds for it are kept.
+    '''
+    held = Category(0)
+
+    for record in read_records(DATA_FILE, FIELD_NAMES):
+        if record.filename == item["filename"]:
+            held |= record.category
+
+    paths = [("image-path", Category.ORIG | Category.TMP),
+             ("timg-path", Category.TIMG),
+             ("crop-path", Category.CROP)]
+
+    for key, category in paths:
+        if item.get(key) and not held & category:
+            if Path(item[key]).is_file():
+                delete_file(Path(item[key]))
+
+
+def pop_prefetched(DATA_FILE, FIELD_NAMES, field_dict, date_time):
+    '''
+    Fill field_dict from the prefetch buffer. Return True if a prepared
+    APOD not yet in the library was available.
+    '''
+    if PREFETCH_QUEUE is None:
+        return False
+
+    owned = get_library_index(DATA_FILE, FIELD_NAMES)["filenames"]
+    item = PREFETCH_QUEUE.pop()
+
+    while item is not None and item["filename"] in owned:
+        discard_prefetched(DATA_FILE, FIELD_NAMES, item)
+        item = PREFETCH_QUEUE.pop()
+
+    PREFETCH_QUEUE.refill()
+
+    if item is None:
         return False
 
+    for key in ("image-path", "timg-path", "crop-path"):
+        item.pop(key, None)
+    field_dict.update(item)
+    field_dict["uid"] = date_time
+    return True
+
 
 def main(FIELD_NAMES, IMAGE_DIR, TIMG_DIR, DATA_FILE, ORIG_SAVE, TIMG_SAVE,
          CROP_SAVE, TMP_SAVE, QUALITY, MIN_SIZE, CROP_RATIO, API_KEY,
          CUSTOM_CMD, CUSTOM_ENV, SET_WALLPAPER, RESP_URL, TIME_INTERVAL,
-         REDOWNLOAD, field_dict):
+         REDOWNLOAD, field_dict, conditional=False, rotate=False):
     '''
        Runs defined functions to download, set wallpaper, and collect
-       APOD data.
+       APOD data. With conditional set, return early when today's APOD
+       has not changed since the last poll. With rotate set as well, a
+       random APOD is set instead of returning.
     '''
     date_time = str(datetime.now().strftime("%Y%m%d%H%M%S%f"))
 
@@ -730,37 +1838,110 @@ def main(FIELD_NAMES, IMAGE_DIR, TIMG_DIR, DATA_FILE, ORIG_SAVE, TIMG_SAVE,
     check_folders_exist(IMAGE_DIR, TIMG_DIR)
     check_data_header(DATA_FILE, FIELD_NAMES)
 
+    base_url = RESP_URL
+
     if REDOWNLOAD.lower() != "true":
         RESP_URL = RESP_URL + API_KEY
     print(RESP_URL)
-    resp = test_connection(RESP_URL)
-    data = formulate_data(DATA_FILE, QUALITY, API_KEY, FIELD_NAMES, REDOWNLOAD,
-                          field_dict, date_time, resp)
+
+    data = False
+
+    if conditional:
+        resp = poll_connection(RESP_URL)
+
+        if resp is None:
+            print("main: APOD not modified")
+
+            if not rotate:
+                return
+
+    else:
+        resp = test_connection(RESP_URL)
+
+    if resp is not None or not conditional:
+        data = formulate_data(DATA_FILE, QUALITY, API_KEY, FIELD_NAMES,
+                              REDOWNLOAD, field_dict, date_time, resp)
+
+    prefetched = False
+    hedged = False
 
     if data != True:
         field_dict = reset_field_dict(field_dict)
-        data = formulate_data_loop(DATA_FILE, QUALITY, API_KEY, FIELD_NAMES,
-                                   REDOWNLOAD, field_dict, date_time)
+        prefetched = pop_prefetched(DATA_FILE, FIELD_NAMES, field_dict,
+                                    date_time)
 
-    download_apod(IMAGE_DIR, field_dict)
-    dimensions = verify_dimensions(IMAGE_DIR, MIN_SIZE, field_dict)
+        if not prefetched and HEDGE > 0:
+            hedged = hedged_random(DATA_FILE, QUALITY, API_KEY, FIELD_NAMES,
+                                   REDOWNLOAD, IMAGE_DIR, MIN_SIZE,
+                                   field_dict, date_time, busy_filenames())
 
-    if REDOWNLOAD.lower() != "true":
-        while dimensions is False:
-            field_dict["uid"] = date_time
+        # no candidate won the hedge, pick one the usual way.
+        if not prefetched and not hedged:
+            field_dict = reset_field_dict(field_dict)
+            data = formulate_data_loop(DATA_FILE, QUALITY, API_KEY,
+                                       FIELD_NAMES, REDOWNLOAD, field_dict,
+                                       date_time, busy_filenames())
+
+    # a prefetched APOD is already downloaded, verified and cropped.
+    if not prefetched:
+        rejected = set()
+        downloaded = hedged or download_apod(IMAGE_DIR, field_dict, MIN_SIZE)
+        dimensions = False
+        # the downloaded image is read and decoded once for all the steps.
+        pipeline = ImagePipeline(
+                Path(IMAGE_DIR).joinpath(field_dict["filename"]))
+
+        if downloaded:
+            dimensions = verify_dimensions(IMAGE_DIR, MIN_SIZE, field_dict,
+                                           pipeline)
+
+        if REDOWNLOAD.lower() != "true":
+            while dimensions is False:
+                if downloaded:
+                    field_dict["uid"] = date_time
+
+                    create_thumbnail(IMAGE_DIR, TIMG_DIR, DATA_FILE,
+                                     FIELD_NAMES, field_dict, pipeline)
+                    append_data(DATA_FILE, FIELD_NAMES, field_dict)
+
+                # dropped during the download, logged without files.
+                else:
+                    log_rejected(DATA_FILE, FIELD_NAMES, field_dict,
+                                 date_time)
 
+                pipeline.close()
+                rejected.add(field_dict["filename"])
+                field_dict = reset_field_dict(field_dict)
+
+                if not formulate_data_loop(DATA_FILE, QUALITY, API_KEY,
+                                           FIELD_NAMES, REDOWNLOAD,
+                                           field_dict, date_time,
+                                           rejected | busy_filenames()):
+                    print("main: no APOD found above MIN_SIZE")
+                    return
+
+                downloaded = download_apod(IMAGE_DIR, field_dict, MIN_SIZE)
+
+                if not downloaded and "tmp" not in field_dict["category"]:
+                    restore_date(field_dict)
+
+                pipeline = ImagePipeline(
+                        Path(IMAGE_DIR).joinpath(field_dict["filename"]))
+
+                if downloaded:
+                    dimensions = verify_dimensions(IMAGE_DIR, MIN_SIZE,
+                                                   field_dict, pipeline)
+
+        with pipeline:
             create_thumbnail(IMAGE_DIR, TIMG_DIR, DATA_FILE, FIELD_NAMES,
-                             field_dict)
-            append_data(DATA_FILE, FIELD_NAMES, field_dict)
-            field_dict = reset_field_dict(field_dict)
-            formulate_data_loop(DATA_FILE, QUALITY, API_KEY, FIELD_NAMES,
-                                REDOWNLOAD, field_dict, date_time)
-            download_apod(IMAGE_DIR, field_dict)
-            dimensions = verify_dimensions(IMAGE_DIR, MIN_SIZE, field_dict)
-
-    create_thumbnail(IMAGE_DIR, TIMG_DIR, DATA_FILE, FIELD_NAMES, field_dict)
-    crop_image(IMAGE_DIR, DATA_FILE, QUALITY, MIN_SIZE, CROP_RATIO,
-               FIELD_NAMES, field_dict)
+                             field_dict, pipeline)
+            crop_image(IMAGE_DIR, DATA_FILE, QUALITY, MIN_SIZE, CROP_RATIO,
+                       FIELD_NAMES, field_dict, pipeline)
+
+    if PREFETCH_QUEUE is not None:
+        for rejected_dict in PREFETCH_QUEUE.take_rejected():
+            log_rejected(DATA_FILE, FIELD_NAMES, rejected_dict, date_time)
+
     append_data(DATA_FILE, FIELD_NAMES, field_dict)
 
     if (SET_WALLPAPER.lower() == "true"):
@@ -773,9 +1954,24 @@ def main(FIELD_NAMES, IMAGE_DIR, TIMG_DIR, DATA_FILE, ORIG_SAVE, TIMG_SAVE,
             time.sleep(TIME_INTERVAL)
             main(FIELD_NAMES, IMAGE_DIR, TIMG_DIR, DATA_FILE, ORIG_SAVE,
                  TIMG_SAVE, CROP_SAVE, TMP_SAVE, QUALITY, MIN_SIZE, CROP_RATIO,
-                 API_KEY, CUSTOM_CMD, CUSTOM_ENV, SET_WALLPAPER, RESP_URL,
-                 TIME_INTERVAL, field_dict)
+                 API_KEY, CUSTOM_CMD, CUSTOM_ENV, SET_WALLPAPER, base_url,
+                 0, REDOWNLOAD, reset_field_dict(field_dict),
+                 conditional=True, rotate=rotate)
         SystemExit(0)
 
 if __name__ == "__main__":
-    init_variables()
+    if len(sys.argv) > 1 and sys.argv[1] == "backfill":
+        from backfill import main as backfill_main
+        backfill_main(sys.argv[2:])
+
+    elif len(sys.argv) > 1 and sys.argv[1] == "sync":
+        init_sync()
+
+    elif len(sys.argv) > 1 and sys.argv[1] in ("thumbnails", "crops"):
+        init_regenerate(sys.argv[1])
+
+    elif len(sys.argv) > 2 and sys.argv[1] in ("export", "import"):
+        init_transfer(sys.argv[1], sys.argv[2])
+
+    else:
+        init_variables()
@@ -0,0 +1,136 @@
+# -*- mode: python ; coding: utf-8 -*-
+'''
+Process pool for bulk image work. Verifying, thumbnailing and cropping
+are CPU bound Pillow calls, the backfill and the thumbnails and crops
+commands run them for many images at once across every core. Jobs and
+results are plain dicts so they can be passed between processes, the
+caller applies the results and writes the data file once.
+ '''
+
+import os
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import (ProcessPoolExecutor, FIRST_COMPLETED,
+                                as_completed, wait)
+
+from pipeline import ImagePipeline, crop_box
+
+
+def pool_size(WORKERS):
+    '''Return the amount of worker processes, WORKERS 0 is one per cpu.'''
+    return int(WORKERS) or os.cpu_count() or 1
+
+
+def image_executor(WORKERS=0):
+    '''
+    Return a process pool for process_image. Workers are spawned rather
+    than forked, the callers run threads of their own.
+    '''
+    return ProcessPoolExecutor(max_workers=pool_size(WORKERS),
+                               mp_context=multiprocessing.get_context("spawn"))
+
+
+def crop_path(IMAGE_DIR, filename):
+    crop_filename = filename.split(".")
+    return Path(IMAGE_DIR).joinpath(
+            f"{crop_filename[0]}-crop.{crop_filename[1]}")
+
+
+def image_job(IMAGE_DIR, TIMG_DIR, filename, MIN_SIZE="0x0", CROP_RATIO=None,
+              thumbnail=True):
+    '''
+    Return a job for process_image. Without a CROP_RATIO no crop is made,
+    an image below MIN_SIZE is never cropped.
+    '''
+    return {"filename": filename,
+            "image-path": str(Path(IMAGE_DIR).joinpath(filename)),
+            "timg-path": (str(Path(TIMG_DIR).joinpath(filename))
+                          if thumbnail else None),
+            "crop-path": (str(crop_path(IMAGE_DIR, filename))
+                          if CROP_RATIO else None),
+            "min-size": MIN_SIZE,
+            "crop-ratio": CROP_RATIO}
+
+
+def process_image(job):
+    '''
+    Verify, thumbnail and crop the image of a job in a worker process.
+    Return a dict of the results, "error" is set if a step failed.
+    '''
+    result = {"filename": job["filename"], "error": None, "undersized": False,
+              "timg": False, "crop": False}
+
+    try:
+        min_width, min_height = (int(size) for size in
+                                 job["min-size"].split("x"))
+
+    except ValueError:
+        min_width, min_height = (0, 0)
+
+    try:
+        with ImagePipeline(job["image-path"]) as pipeline:
+            width, height = pipeline.dimensions()
+            result["img-WxH"] = f"{width}x{height}"
+            result["img-size"] = pipeline.file_size()
+            result["undersized"] = width < min_width or height < min_height
+
+            # a failed thumbnail does not keep the crop from being made.
+            if job["timg-path"] is not None:
+                try:
+                    pipeline.thumbnail(job["timg-path"])
+                    result["timg"] = True
+
+                except (PermissionError, OSError, ValueError) as error:
+                    result["error"] = str(error)
+
+            if job["crop-path"] is not None and not result["undersized"]:
+                pipeline.crop(job["crop-path"],
+                              crop_box(width, height, job["crop-ratio"]))
+                result["crop"] = True
+
+    except (FileNotFoundError, PermissionError, OSError, ValueError) as error:
+        result["error"] = str(error)
+
+    return result
+
+
+def apply_result(field_dict, result):
+    '''Copy the dimensions and categories of a result into a field dict.'''
+    field_dict["img-WxH"] = result.get("img-WxH", field_dict["img-WxH"])
+    field_dict["img-size"] = result.get("img-size", field_dict["img-size"])
+    category = field_dict["category"]
+
+    if result["undersized"]:
+        if "orig" in category:
+            category.remove("orig")
+
+        if "tmp" not in category:
+            category.append("tmp")
+
+    for name in ("timg", "crop"):
+        if result[name] and name not in category:
+            category.append(name)
+
+
+def process_images(jobs, WORKERS=0):
+    '''
+    Run jobs on a pool of worker processes and yield their results as
+    they finish. At most twice the pool size of jobs are queued at once,
+    so jobs can be a long generator.
+    '''
+    workers = pool_size(WORKERS)
+
+    with image_executor(workers) as executor:
+        pending = set()
+
+        for job in jobs:
+            pending.add(executor.submit(process_image, job))
+
+            if len(pending) >= workers * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    yield future.result()
+
+        for future in as_completed(pending):
+            yield future.result()
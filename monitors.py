@@ -0,0 +1,85 @@
+# -*- mode: python ; coding: utf-8 -*-
+'''
+Sizes of the connected monitors, so a wallpaper can be rendered at exactly
+the resolution it is shown at instead of handing the desktop the full
+image to scale on every login. The sizes come from the MONITORS setting,
+xrandr on X11 or the primary screen on Windows, the gui passes its own
+from Qt.
+ '''
+
+import re
+import sys
+import ctypes
+import subprocess
+from collections import namedtuple
+
+Monitor = namedtuple("Monitor", ["name", "width", "height"])
+
+XRANDR_MONITOR = re.compile(r"^(\S+) connected (primary )?(\d+)x(\d+)\+\d+\+\d+",
+                            re.MULTILINE)
+
+
+def parse_monitors(MONITORS):
+    '''
+    Return the monitors of a "1920x1080, 2560x1440" setting, the first is
+    the primary one. Malformed sizes are skipped.
+    '''
+    monitors = []
+
+    for number, size in enumerate(str(MONITORS).split(",")):
+        try:
+            width, height = (int(side) for side in size.strip().split("x"))
+
+        except ValueError:
+            continue
+
+        if width > 0 and height > 0:
+            monitors.append(Monitor(str(number), width, height))
+
+    return monitors
+
+
+def parse_xrandr(output):
+    '''Return the active monitors of xrandr --query, primary first.'''
+    monitors = []
+
+    for match in XRANDR_MONITOR.finditer(output):
+        monitor = Monitor(match.group(1), int(match.group(3)),
+                          int(match.group(4)))
+
+        if match.group(2):
+            monitors.insert(0, monitor)
+
+        else:
+            monitors.append(monitor)
+
+    return monitors
+
+
+def detect_monitors():
+    '''
+    Return the connected monitors, primary first, or an empty list if
+    they can not be detected.
+    '''
+    if "win32" in sys.platform.lower():
+        user32 = ctypes.windll.user32
+        user32.SetProcessDPIAware()
+        return [Monitor("0", user32.GetSystemMetrics(0),
+                        user32.GetSystemMetrics(1))]
+
+    if "darwin" in sys.platform.lower():
+        return []
+
+    try:
+        output = subprocess.run(["xrandr", "--query"],
+                                capture_output=True,
+                                text=True,
+                                timeout=5
+                                ).stdout
+
+    except (FileNotFoundError, PermissionError, OSError,
+            subprocess.SubprocessError) as error:
+        print(f"detect_monitors: {error}")
+        return []
+
+    return parse_xrandr(output)
@@ -0,0 +1,154 @@
+# -*- mode: python ; coding: utf-8 -*-
+'''
+One downloaded APOD shared by verify_dimensions, create_thumbnail and
+crop_image. The file is read from disk once and decoded at most once, the
+dimensions come from the header and the thumbnail and crop are both made
+from the same decoded pixels.
+
+A JPEG thumbnail made before the pixels are decoded takes a fast path
+instead, it is decoded straight at a reduced DCT scale. Other formats can
+not be decoded smaller, their thumbnail is made from the decoded pixels
+the crop uses as well.
+ '''
+
+import io
+from pathlib import Path
+
+from PIL import Image
+
+THUMBNAIL_SIZE = (310, 310)
+# The fast path stops reducing at this multiple of the thumbnail size and
+# leaves the rest to a proper resample, as Image.thumbnail does.
+REDUCING_GAP = 2
+# Modes Image.reduce works on, others are converted to RGB first.
+REDUCE_MODES = ("L", "RGB", "RGBA", "CMYK")
+
+
+def fit_size(width, height, size):
+    '''Return width and height scaled down to fit within size.'''
+    scale = min(size[0] / width, size[1] / height, 1)
+    return (max(1, round(width * scale)), max(1, round(height * scale)))
+
+
+def fast_thumbnail(image, size=THUMBNAIL_SIZE):
+    '''
+    Return an RGB copy of an undecoded image fitting within size. draft
+    picks the smallest JPEG scale of 1/2, 1/4 or 1/8 that is still
+    REDUCING_GAP times size, reduce does the same for other formats.
+    Palette, bilevel and 16 bit images are converted before reducing.
+    '''
+    gap_size = (size[0] * REDUCING_GAP, size[1] * REDUCING_GAP)
+    image.draft("RGB", gap_size)
+    factor = min(image.width // gap_size[0], image.height // gap_size[1])
+
+    if factor > 1:
+        if image.mode not in REDUCE_MODES:
+            image = image.convert("RGB")
+
+        image = image.reduce(factor)
+
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+
+    return image.resize(fit_size(image.width, image.height, size),
+                        Image.Resampling.BICUBIC)
+
+
+def crop_box(width, height, CROP_RATIO):
+    '''Return the centered (left, upper, right, lower) box of CROP_RATIO.'''
+    crop_ratio = CROP_RATIO.split(":")
+    crop_ratio = int(crop_ratio[1]) / int(crop_ratio[0])
+
+    if int(width) >= int(height):
+        crop_height = int(height * crop_ratio)
+
+    else:
+        crop_height = int(width * crop_ratio)
+
+    upper = int((height - crop_height) / 2)
+    return (0, upper, width, upper + crop_height)
+
+
+class ImagePipeline:
+    '''
+    Lazily opened image, raises OSError like Image.open. Use it as a
+    context manager or call close when done.
+    '''
+
+    def __init__(self, image_path):
+        self.image_path = Path(image_path)
+        self.data = None
+        self.image = None
+        self.rgb = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open(self):
+        '''Read the file and parse its header, the pixels are not decoded.'''
+        if self.image is None:
+            self.data = self.image_path.read_bytes()
+            self.image = Image.open(io.BytesIO(self.data))
+
+        return self.image
+
+    def file_size(self):
+        self.open()
+        return len(self.data)
+
+    def dimensions(self):
+        image = self.open()
+        return (image.width, image.height)
+
+    def pixels(self):
+        '''Return the image in RGB, decoding it on first use.'''
+        if self.rgb is None:
+            image = self.open()
+            image.load()
+            self.rgb = image if image.mode == "RGB" else image.convert("RGB")
+
+        return self.rgb
+
+    def save(self, image, path):
+        image.save(path,
+                   quality=95,
+                   optimize=True,
+                   subsampling=0,
+                   compress_level=0,
+                   icc_profile=self.open().info.get("icc_profile")
+                   )
+
+    def thumbnail(self, path, size=THUMBNAIL_SIZE):
+        '''
+        Save a copy fitting within size, keeping the aspect ratio. Decoded
+        pixels are resized into a new image so a crop can still be made
+        from them. An undecoded JPEG takes the fast path, which decodes a
+        reduced copy, other formats are decoded once for both.
+        '''
+        if self.rgb is None and self.open().format == "JPEG":
+            self.open()
+
+            with Image.open(io.BytesIO(self.data)) as image:
+                self.save(fast_thumbnail(image, size), path)
+
+            return
+
+        image = self.pixels()
+        self.save(image.resize(fit_size(image.width, image.height, size),
+                               Image.Resampling.BICUBIC,
+                               reducing_gap=REDUCING_GAP), path)
+
+    def crop(self, path, box):
+        '''Save the (left, upper, right, lower) box of the image.'''
+        self.save(self.pixels().crop(box), path)
+
+    def close(self):
+        if self.image is not None:
+            self.image.close()
+
+        self.data = None
+        self.image = None
+        self.rgb = None
@@ -0,0 +1,134 @@
+# -*- mode: python ; coding: utf-8 -*-
+'''
+Buffer of random APODs that are already downloaded, verified,
+thumbnailed and cropped. A random pick pops one and only has to set the
+wallpaper, the buffer is refilled on a background thread. The buffer is
+saved to disk so prepared images survive between runs.
+
+Images the refill rejected for their size are kept in the buffer too,
+main logs them to the data file before its own entry so a file-less
+entry never becomes the latest one.
+ '''
+
+import threading
+from pathlib import Path
+from json import loads, dumps, decoder
+
+
+def prefetch_path(DATA_FILE):
+    '''Return the path of the prefetch buffer next to the data file.'''
+    return Path(DATA_FILE).parent.joinpath("prefetch.data")
+
+
+class PrefetchQueue:
+    '''
+    Holds up to size prepared field dicts. prepare is called with a set
+    of filenames to avoid and returns a new field dict, or None when no
+    candidate could be prepared. discard is called with the items that
+    are dropped without being used, to delete their files.
+    '''
+
+    def __init__(self, PREFETCH_FILE, size, prepare, discard=None):
+        self.prefetch_file = PREFETCH_FILE
+        self.size = int(size)
+        self.prepare = prepare
+        self.discard = discard or (lambda item: None)
+        self.items = []
+        self.rejected = []
+        self.lock = threading.Lock()
+        self.thread = None
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.prefetch_file, "r") as prefetch_file:
+                items = loads(prefetch_file.read())
+
+            # older buffers are a plain list of items.
+            if isinstance(items, dict):
+                self.rejected = items["rejected"]
+                items = items["items"]
+
+            for item in items:
+                if Path(item["image-path"]).is_file():
+                    self.items.append(item)
+
+                else:
+                    self.discard(item)
+
+        except FileNotFoundError:
+            pass
+
+        except (PermissionError, OSError, decoder.JSONDecodeError,
+                KeyError, TypeError) as error:
+            print(f"PrefetchQueue.load: {error}")
+
+    def save(self):
+        try:
+            with open(self.prefetch_file, "w") as prefetch_file:
+                prefetch_file.write(dumps({"items": self.items,
+                                           "rejected": self.rejected}))
+
+        except (PermissionError, OSError) as error:
+            print(f"PrefetchQueue.save: {error}")
+
+    def filenames(self):
+        '''Return the filenames waiting in the buffer, rejected included.'''
+        with self.lock:
+            return {item["filename"] for item in self.items + self.rejected}
+
+    def reject(self, item):
+        '''Keep an item rejected for its size until take_rejected.'''
+        with self.lock:
+            self.rejected.append(item)
+            self.save()
+
+    def take_rejected(self):
+        '''Return and forget the rejected items.'''
+        with self.lock:
+            rejected = self.rejected
+            self.rejected = []
+
+            if len(rejected) != 0:
+                self.save()
+
+            return rejected
+
+    def pop(self):
+        '''Return the oldest prepared field dict, None if empty.'''
+        with self.lock:
+            while len(self.items) != 0:
+                item = self.items.pop(0)
+
+                if Path(item["image-path"]).is_file():
+                    self.save()
+                    return item
+
+                self.discard(item)
+
+            self.save()
+            return None
+
+    def refill(self):
+        '''Top the buffer up on a background thread.'''
+        if self.thread is not None and self.thread.is_alive():
+            return
+
+        self.thread = threading.Thread(target=self.fill, daemon=True)
+        self.thread.start()
+
+    def fill(self):
+        while len(self.items) < self.size:
+            item = self.prepare(self.filenames())
+
+            if item is None:
+                return
+
+            with self.lock:
+                self.items.append(item)
+                self.save()
+
+    def join(self):
+        '''Wait for a running refill to finish.'''
+        if self.thread is not None:
+            self.thread.join()
@@ -0,0 +1,110 @@
+# -*- mode: python ; coding: utf-8 -*-
+'''
+Token bucket pacing every request to api.nasa.gov. The bucket follows
+the X-RateLimit-Limit and X-RateLimit-Remaining headers of each answer,
+and stops sending after a 429 until its Retry-After has passed.
+ '''
+
+import time
+import threading
+from email.utils import parsedate_to_datetime
+
+# Requests per RATE_PERIOD assumed until the api reports its own limit.
+# DEMO_KEY allows 30 an hour, registered keys 1000.
+RATE_LIMIT = 30
+RATE_PERIOD = 60 * 60
+# Longest time in seconds a request waits for the bucket before failing.
+RATE_MAX_WAIT = 5 * 60
+# Shorter wait for requests a user is waiting on, the wallpaper and gui
+# rather fail and try again on the next run.
+RATE_INTERACTIVE_WAIT = 10
+
+
+def retry_after(value, default):
+    '''Parse a Retry-After header, seconds or a http date.'''
+    try:
+        return max(0.0, float(value))
+
+    except (TypeError, ValueError):
+        pass
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+
+    except (TypeError, ValueError, IndexError):
+        return default
+
+
+class RateLimiter:
+    '''Thread safe token bucket shared by all api requests.'''
+
+    def __init__(self, limit=RATE_LIMIT, period=RATE_PERIOD,
+                 max_wait=RATE_MAX_WAIT):
+        self.limit = limit
+        self.period = period
+        self.max_wait = max_wait
+        self.tokens = float(limit)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def refill(self, now):
+        elapsed = now - self.updated
+        self.tokens = min(float(self.limit),
+                          self.tokens + elapsed * self.limit / self.period)
+        self.updated = now
+
+    def acquire(self, max_wait=None):
+        '''
+        Take a token, sleep until one is available. Return False if that
+        would take longer than max_wait, the limiter's own by default.
+        '''
+        if max_wait is None:
+            max_wait = self.max_wait
+
+        waited = 0.0
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.refill(now)
+
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+
+                wait = max(self.blocked_until - now,
+                           (1 - self.tokens) * self.period / self.limit)
+
+            if waited + wait > max_wait:
+                print(f"RateLimiter: quota exhausted, next request in"
+                      + f" {round(wait)}s")
+                return False
+
+            time.sleep(wait)
+            waited += wait
+
+    def update(self, resp):
+        '''Follow the quota headers of a response, back off on a 429.'''
+        with self.lock:
+            now = time.monotonic()
+            self.refill(now)
+
+            try:
+                self.limit = max(1, int(resp.headers["X-RateLimit-Limit"]))
+
+            except (KeyError, TypeError, ValueError):
+                pass
+
+            try:
+                remaining = int(resp.headers["X-RateLimit-Remaining"])
+                self.tokens = min(float(self.limit), float(remaining))
+
+            except (KeyError, TypeError, ValueError):
+                pass
+
+            if resp.status_code == 429:
+                self.tokens = 0.0
+                wait = retry_after(resp.headers.get("Retry-After"),
+                                   self.period / self.limit)
+                self.blocked_until = max(self.blocked_until, now + wait)
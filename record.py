@@ -0,0 +1,153 @@
+# -*- mode: python ; coding: utf-8 -*-
+'''
+Typed representation of a data file entry. A row is parsed once into an
+ApodRecord with a parsed date, integer dimensions and byte size, and the
+categories as a bitmask, instead of keeping every field as a string.
+ '''
+
+from enum import IntFlag
+from datetime import date
+
+SIZE_UNITS = {"b": 1, "kb": 1024, "mb": 1024 * 1024, "gb": 1024 ** 3}
+
+
+class Category(IntFlag):
+    '''The files kept for an entry, see dir_cleanup.'''
+    ORIG = 1
+    TMP = 2
+    TIMG = 4
+    CROP = 8
+
+    @classmethod
+    def parse(cls, category):
+        '''Return the flags of a category list or its str() form.'''
+        if isinstance(category, cls):
+            return category
+
+        if isinstance(category, str):
+            category = category.strip("][").replace("'", "").split(", ")
+
+        flags = cls(0)
+
+        for name in category:
+            if name.upper() in cls.__members__:
+                flags |= cls[name.upper()]
+
+        return flags
+
+    def names(self):
+        '''Return the category list as the data file stores it.'''
+        return [flag.name.lower() for flag in Category if flag in self]
+
+
+def parse_size(value):
+    '''Return a size in bytes from an integer or a "3.2 Mb" string.'''
+    try:
+        return int(value)
+
+    except (TypeError, ValueError):
+        pass
+
+    try:
+        number, unit = str(value).split()
+        return int(float(number) * SIZE_UNITS[unit.lower()])
+
+    except (ValueError, KeyError):
+        return 0
+
+
+def format_size(size):
+    '''Return a size in bytes the way the gallery shows it.'''
+    if size < 102400:
+        return f"{round(size / 1024, 2)} Kb"
+
+    return f"{round(size / 1024 / 1024, 2)} Mb"
+
+
+def parse_dimensions(value):
+    '''Return the width and height of a "WxH" string, 0 if unknown.'''
+    try:
+        width, height = str(value).split("x")
+        return int(width), int(height)
+
+    except ValueError:
+        return 0, 0
+
+
+class ApodRecord:
+    '''One entry of the data file.'''
+
+    __slots__ = ("date", "title", "explanation", "html", "img_url",
+                 "filename", "width", "height", "size", "copyright", "uid",
+                 "category")
+
+    def __init__(self, date, title, explanation, html, img_url, filename,
+                 width, height, size, copyright, uid, category):
+        self.date = date
+        self.title = title
+        self.explanation = explanation
+        self.html = html
+        self.img_url = img_url
+        self.filename = filename
+        self.width = width
+        self.height = height
+        self.size = size
+        self.copyright = copyright
+        self.uid = uid
+        self.category = category
+
+    @classmethod
+    def from_row(cls, row):
+        '''Parse a data file row, or return a record unchanged.'''
+        if isinstance(row, cls):
+            return row
+
+        try:
+            apod_date = date.fromisoformat(str(row.get("date", "")))
+
+        except ValueError:
+            apod_date = None
+
+        width, height = parse_dimensions(row.get("img-WxH", ""))
+        return cls(apod_date,
+                   str(row.get("title", "")),
+                   str(row.get("explanation", "")),
+                   str(row.get("html", "")),
+                   str(row.get("img-url", "")),
+                   str(row.get("filename", "")),
+                   width,
+                   height,
+                   parse_size(row.get("img-size", "")),
+                   str(row.get("copyright", "")),
+                   str(row.get("uid", "")),
+                   Category.parse(row.get("category", "")))
+
+    def with_category(self, category):
+        '''Return a copy of the record with other categories.'''
+        return ApodRecord(self.date, self.title, self.explanation, self.html,
+                          self.img_url, self.filename, self.width,
+                          self.height, self.size, self.copyright, self.uid,
+                          category)
+
+    def date_text(self):
+        return "" if self.date is None else self.date.isoformat()
+
+    def dimensions(self):
+        return f"{self.width}x{self.height}"
+
+    def size_text(self):
+        return format_size(self.size)
+
+    def to_row(self):
+        '''Return the record as a data file row.'''
+        return {"date": self.date_text(),
+                "title": self.title,
+                "explanation": self.explanation,
+                "html": self.html,
+                "img-url": self.img_url,
+                "filename": self.filename,
+                "img-WxH": self.dimensions(),
+                "img-size": str(self.size),
+                "copyright": self.copyright,
+                "uid": self.uid,
+                "category": str(self.category.names())}
@@ -0,0 +1,520 @@
+# -*- mode: python ; coding: utf-8 -*-
+'''
+Storage backends for the APOD data file. The data file is a CSV file by
+default. A DATA_FILE ending in .db, .sqlite or .sqlite3 is kept in an
+SQLite database instead, with indexed date, filename, uid and category
+columns. Both backends take and return rows as dictionaries keyed by
+FIELD_NAMES and raise on errors, callers handle them.
+
+Rows are parsed once per process into ApodRecords kept in memory. The
+cached records are dropped when the data file's modification time or size
+changes, so writes by other processes are picked up, and appends made here
+are applied to them in place.
+
+A row's uid is raised above the latest one when it is appended, so the
+data file is always in uid order and the last appended row is the latest
+whether or not the records are cached.
+
+Every access holds a lock on a .lock file next to the data file, shared
+by all processes using it. CSV rewrites go to a temporary file that is
+synced and renamed over the data file, an interrupted write leaves the
+old file in place.
+ '''
+
+import csv
+import io
+import os
+import locale
+import sqlite3
+import threading
+from bisect import insort
+from datetime import datetime
+from pathlib import Path
+
+try:
+    import fcntl
+
+except ImportError:
+    import msvcrt
+    fcntl = None
+
+from record import ApodRecord
+
+SQLITE_SUFFIXES = (".db", ".sqlite", ".sqlite3")
+# Bytes read per step when scanning the CSV file backward from its end.
+TAIL_BLOCK = 8 * 1024
+INDEXED_FIELDS = ("date", "filename", "uid", "category")
+
+# Backends by data file path, see get_storage().
+STORAGES = {}
+
+
+def get_storage(DATA_FILE, FIELD_NAMES):
+    '''Return the storage backend for a data file, chosen by its suffix.'''
+    key = (str(DATA_FILE), tuple(FIELD_NAMES))
+
+    if key not in STORAGES:
+        if Path(DATA_FILE).suffix.lower() in SQLITE_SUFFIXES:
+            STORAGES[key] = SQLiteStorage(DATA_FILE, FIELD_NAMES)
+
+        else:
+            STORAGES[key] = CSVStorage(DATA_FILE, FIELD_NAMES)
+
+    return STORAGES[key]
+
+
+def stat_stamp(file):
+    '''Return the modification time and size of a file, None if missing.'''
+    try:
+        stat = os.stat(file)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    except (FileNotFoundError, OSError):
+        return None
+
+
+def lock_file(file):
+    '''Block until an exclusive lock on an open file is taken.'''
+    if fcntl is not None:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX)
+        return
+
+    file.seek(0)
+
+    while True:
+        # LK_LOCK gives up with an OSError after 10 seconds.
+        try:
+            msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+            return
+
+        except OSError:
+            continue
+
+
+def unlock_file(file):
+    if fcntl is not None:
+        fcntl.flock(file.fileno(), fcntl.LOCK_UN)
+        return
+
+    file.seek(0)
+    msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class FileLock:
+    '''
+    Lock shared between processes through a lock file. Reentrant within a
+    process, the lock file is locked by the outermost holder only.
+    '''
+
+    def __init__(self, LOCK_FILE):
+        self.lock_file = LOCK_FILE
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.file = None
+
+    def __enter__(self):
+        self.lock.acquire()
+
+        if self.depth == 0:
+            try:
+                self.file = open(self.lock_file, "a+")
+                lock_file(self.file)
+
+            except BaseException:
+                if self.file is not None:
+                    self.file.close()
+                    self.file = None
+
+                self.lock.release()
+                raise
+
+        self.depth += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+
+        if self.depth == 0:
+            try:
+                unlock_file(self.file)
+
+            finally:
+                self.file.close()
+                self.file = None
+
+        self.lock.release()
+
+
+def write_atomic(file, write):
+    '''
+    Call write with a temporary file next to file, then sync it and rename
+    it over file.
+    '''
+    temp_file = Path(f"{file}.tmp")
+
+    try:
+        with open(temp_file, "w", newline="") as data_file:
+            write(data_file)
+            data_file.flush()
+            os.fsync(data_file.fileno())
+
+        os.replace(temp_file, file)
+
+    except BaseException:
+        try:
+            os.remove(temp_file)
+
+        except OSError:
+            pass
+
+        raise
+
+    # make the rename itself durable where directories can be synced.
+    if fcntl is not None:
+        directory = os.open(Path(file).parent, os.O_RDONLY)
+
+        try:
+            os.fsync(directory)
+
+        finally:
+            os.close(directory)
+
+
+def db_value(value):
+    '''Store lists, such as the category, the way the CSV file does.'''
+    if isinstance(value, list):
+        return str(value)
+
+    return value
+
+
+def uid_key(record):
+    return record.uid
+
+
+def next_uid(uid):
+    '''Return the uid after uid, in the same YYYYmmddHHMMSSffffff form.'''
+    try:
+        return str(int(uid) + 1).zfill(len(uid))
+
+    except ValueError:
+        return datetime.now().strftime("%Y%m%d%H%M%S%f")
+
+
+class Storage:
+    '''
+    Cached view shared by the backends. A backend provides stamp,
+    load_rows, add_rows and replace_rows.
+    '''
+
+    def __init__(self, DATA_FILE, FIELD_NAMES):
+        self.data_file = DATA_FILE
+        self.field_names = FIELD_NAMES
+        self.rows = None
+        self.rows_stamp = None
+        self.lock = FileLock(f"{DATA_FILE}.lock")
+
+    def cached_rows(self):
+        '''Return the cached records, parsing the data file if it changed.'''
+        stamp = self.stamp()
+
+        if self.rows is None or self.rows_stamp != stamp:
+            self.rows = sorted((ApodRecord.from_row(row)
+                                for row in self.load_rows()), key=uid_key)
+            self.rows_stamp = stamp
+
+        return self.rows
+
+    def is_cached(self):
+        return self.rows is not None and self.rows_stamp == self.stamp()
+
+    def read_rows(self):
+        '''Return every row, header excluded, sorted by uid.'''
+        with self.lock:
+            return [record.to_row() for record in self.cached_rows()]
+
+    def read_records(self):
+        '''Return every record sorted by uid, they must not be changed.'''
+        with self.lock:
+            return list(self.cached_rows())
+
+    def append_rows(self, rows):
+        '''
+        Append rows. A uid not above the latest one is replaced by the
+        next uid, a run takes its uid when it starts but appends when it
+        ends and other runs may have appended in between.
+        '''
+        with self.lock:
+            latest = self.latest_row()
+            last = "" if latest is None else str(latest["uid"])
+
+            for row in rows:
+                if str(row.get("uid", "")) <= last:
+                    row["uid"] = next_uid(last)
+
+                last = str(row["uid"])
+
+            cached = self.is_cached()
+            self.add_rows(rows)
+
+            if not cached:
+                self.rows = None
+                return
+
+            for row in rows:
+                insort(self.rows, ApodRecord.from_row(row), key=uid_key)
+
+            self.rows_stamp = self.stamp()
+
+    def write_rows(self, rows):
+        '''Replace every row or record, written in uid order.'''
+        records = sorted((ApodRecord.from_row(row) for row in rows),
+                         key=uid_key)
+
+        with self.lock:
+            self.rows = None
+            self.replace_rows([record.to_row() for record in records])
+            self.rows = records
+            self.rows_stamp = self.stamp()
+
+    def latest_row(self):
+        '''Return the row with the highest uid, None if empty.'''
+        with self.lock:
+            data_rows = self.cached_rows()
+
+            if len(data_rows) == 0:
+                return None
+
+            return data_rows[-1].to_row()
+
+    def latest_record(self):
+        '''Return the record with the highest uid, None if empty.'''
+        row = self.latest_row()
+
+        if row is None:
+            return None
+
+        return ApodRecord.from_row(row)
+
+    def owned(self):
+        '''Return the sets of filenames and dates in the data file.'''
+        with self.lock:
+            records = self.cached_rows()
+            return ({record.filename for record in records},
+                    {record.date_text() for record in records})
+
+
+class CSVStorage(Storage):
+    '''The data file as a CSV file with a header line.'''
+
+    def stamp(self):
+        return stat_stamp(self.data_file)
+
+    def has_header(self):
+        with open(self.data_file, "r") as data_file:
+            return ",".join(self.field_names) in data_file.readline()
+
+    def write_header(self):
+        with self.lock:
+            self.rows = None
+            self.replace_rows([])
+
+    def add_rows(self, rows):
+        with self.lock:
+            with open(self.data_file, "a", newline="") as data_file:
+                writer = csv.DictWriter(data_file,
+                                        fieldnames=self.field_names
+                                        )
+                writer.writerows(rows)
+                data_file.flush()
+                os.fsync(data_file.fileno())
+
+    def replace_rows(self, rows):
+        def write(data_file):
+            writer = csv.DictWriter(data_file,
+                                    fieldnames=self.field_names
+                                    )
+            writer.writeheader()
+            writer.writerows(rows)
+
+        with self.lock:
+            write_atomic(self.data_file, write)
+
+    def load_rows(self):
+        with self.lock:
+            with open(self.data_file, "r", newline="") as data_file:
+                reader = csv.DictReader(data_file,
+                                        self.field_names
+                                        )
+                next(reader, None)
+                return list(reader)
+
+    def latest_row(self):
+        '''
+        Return the row with the highest uid, None if empty. append_rows
+        keeps the file in uid order, so without a current cache the last
+        record is read from the end of the file.
+        '''
+        with self.lock:
+            if self.is_cached():
+                return super().latest_row()
+
+            return self.tail_row()
+
+    def tail_row(self):
+        '''
+        Return the last record by scanning backward from the end of the
+        file. A newline ends a record only outside quotes, that is when an
+        even number of quote characters follows it, so quoted multi-line
+        fields such as the explanation are read whole.
+        '''
+        with open(self.data_file, "rb") as data_file:
+            position = data_file.seek(0, os.SEEK_END)
+            buffer = b""
+
+            while True:
+                size = min(TAIL_BLOCK, position)
+                position -= size
+                data_file.seek(position)
+                buffer = data_file.read(size) + buffer
+                record = buffer.rstrip(b"\r\n")
+                start = None
+                end = len(record)
+                quotes = 0
+
+                while True:
+                    newline = record.rfind(b"\n", 0, end)
+
+                    if newline == -1:
+                        break
+
+                    quotes += record.count(b'"', newline, end)
+
+                    if quotes % 2 == 0:
+                        start = newline + 1
+                        break
+
+                    end = newline
+
+                if start is None and position == 0:
+                    start = 0
+
+                if start is not None:
+                    break
+
+        text = record[start:].decode(locale.getpreferredencoding(False))
+
+        if len(text) == 0:
+            return None
+
+        row = next(csv.reader(io.StringIO(text, newline="")))
+
+        if row == list(self.field_names):
+            return None
+
+        return dict(zip(self.field_names, row))
+
+
+class SQLiteStorage(Storage):
+    '''
+    The data file as an SQLite database in WAL mode. Every call opens
+    its own connection so the backend can be shared across threads.
+    '''
+
+    def __init__(self, DATA_FILE, FIELD_NAMES):
+        super().__init__(DATA_FILE, FIELD_NAMES)
+        self.columns = ", ".join(f'"{name}"' for name in FIELD_NAMES)
+        self.placeholders = ", ".join("?" for name in FIELD_NAMES)
+
+    def connect(self):
+        connection = sqlite3.connect(str(self.data_file), timeout=30)
+        connection.row_factory = sqlite3.Row
+        return connection
+
+    def stamp(self):
+        # writes land in the -wal file until a checkpoint.
+        return (stat_stamp(self.data_file),
+                stat_stamp(f"{self.data_file}-wal"))
+
+    def has_header(self):
+        with self.connect() as connection:
+            table = connection.execute(
+                    "SELECT name FROM sqlite_master"
+                    + " WHERE type = 'table' AND name = 'apod'").fetchone()
+        connection.close()
+        return table is not None
+
+    def write_header(self):
+        '''Create the table and its indexes, existing rows are kept.'''
+        connection = self.connect()
+
+        with connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute(
+                    "CREATE TABLE IF NOT EXISTS apod"
+                    + f" (id INTEGER PRIMARY KEY, {self.columns})")
+
+            for name in INDEXED_FIELDS:
+                if name in self.field_names:
+                    connection.execute(
+                            f'CREATE INDEX IF NOT EXISTS "apod_{name}"'
+                            + f' ON apod ("{name}")')
+        connection.close()
+
+    def add_rows(self, rows):
+        connection = self.connect()
+
+        with connection:
+            connection.executemany(
+                    f"INSERT INTO apod ({self.columns})"
+                    + f" VALUES ({self.placeholders})",
+                    [[db_value(row.get(name, "")) for name in self.field_names]
+                     for row in rows])
+        connection.close()
+
+    def replace_rows(self, rows):
+        '''Replace every row in one transaction.'''
+        connection = self.connect()
+
+        with connection:
+            connection.execute("DELETE FROM apod")
+            connection.executemany(
+                    f"INSERT INTO apod ({self.columns})"
+                    + f" VALUES ({self.placeholders})",
+                    [[db_value(row.get(name, "")) for name in self.field_names]
+                     for row in rows])
+        connection.close()
+
+    def query(self, sql, parameters=()):
+        connection = self.connect()
+
+        try:
+            return [dict(row) for row in connection.execute(sql, parameters)]
+
+        finally:
+            connection.close()
+
+    def load_rows(self):
+        return self.query(f"SELECT {self.columns} FROM apod ORDER BY uid")
+
+    def latest_row(self):
+        '''Return the row with the highest uid, None if empty.'''
+        if self.is_cached():
+            return super().latest_row()
+
+        data_rows = self.query(f"SELECT {self.columns} FROM apod"
+                               + " ORDER BY uid DESC LIMIT 1")
+
+        if len(data_rows) == 0:
+            return None
+
+        return data_rows[0]
+
+    def owned(self):
+        '''Return the sets of filenames and dates in the data file.'''
+        if self.is_cached():
+            return super().owned()
+
+        data_rows = self.query("SELECT filename, date FROM apod")
+        return ({row["filename"] for row in data_rows},
+                {row["date"] for row in data_rows})